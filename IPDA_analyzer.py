@@ -1,182 +1,251 @@
+import numpy as np
+import os
 import pandas as pd
-import csv
 import re
-import matplotlib.pyplot as plt
+import warnings
+
+from IPDA_instrumentation import NULL_STAGE_RECORDER
+from IPDA_plots import render_IPDA_plots
+from IPDA_results import IPDAResults
+
+
+# these are the columns of the regular output from the ddPCR analyzer that we need for the analysis.
+# we read only these columns (by position, because the header names differ between analyzer versions)
+# and give each of them a fixed dtype so that pandas does not have to guess them row by row
+IPDA_CSV_COLUMNS = {
+    0: 'Well',
+    3: 'Sample',
+    5: 'Target',
+    7: 'Concentration',
+    16: 'Ch1+Ch2+',
+    17: 'Ch1+Ch2-',
+    18: 'Ch1-Ch2+',
+    19: 'Ch1-Ch2-',
+    21: 'Number of Droplets'}
+IPDA_CSV_DTYPES = {
+    0: str,
+    3: str,
+    5: str,
+    7: str,
+    16: 'int64',
+    17: 'int64',
+    18: 'int64',
+    19: 'int64',
+    21: 'int64'}
+
+
+# every Target is given one assay role by these regular expressions (capitalization does not matter).
+# a Target gets the first role whose pattern it contains, Targets that contain none of them are not used for the analysis.
+# if your lab names its Targets differently, pass your own dictionary as target_roles
+IPDA_TARGET_ROLES = {
+    'RPP30 fam': 'Rpp30 Fam|Rpp30 Shear',
+    'RPP30 vic': 'vic',
+    'Gag': 'Psi|Gag',
+    'Env': 'env'}
+
+# after the quality control, these columns are stored in compact dtypes.
+# a plate has only a few hundred different Wells, Samples and Targets, so categories are much smaller than strings
+# and make every merge and groupby on them faster. The droplet counts always fit into int32
+IPDA_COMPACT_DTYPES = {
+    'Well': 'category',
+    'Sample': 'category',
+    'Target': 'category',
+    'Ch1+Ch2+': 'int32',
+    'Ch1+Ch2-': 'int32',
+    'Ch1-Ch2+': 'int32',
+    'Ch1-Ch2-': 'int32'}
+
+
+# the wells of row M of a 384 well plate (rows A to P, columns 1 to 24). A 96 well plate has no row M
+ROW_M_WELL_PATTERN = r'M(0[1-9]|1[0-9]|2[0-4])'
+
+
+# This function finds the merged rows of an export of "Both" single and merged data, their Well starts with 'M'.
+# A 384 well plate (recognized by its wells in the rows I to P) also has a real row M, the wells M01 to M24 are kept.
+# If the merged rows of such a file are numbered like wells (e.g. M25), merged rows M01 to M24 can't be told apart
+# from row M, which is reported with a warning.
+# Each different Well name is tested once. Returns a boolean Series that is True for the merged rows
+def merged_IPDA_wells(wells):
+
+    well_names = pd.Series(wells.unique())
+    merged_names = well_names.str.startswith('M')
+    if well_names.str[0].isin(list('IJKLNOP')).any():
+        row_M_names = well_names.str.fullmatch(ROW_M_WELL_PATTERN)
+        merged_names = merged_names & ~row_M_names
+        if row_M_names.any() and well_names[merged_names].str.fullmatch(r'M\d\d').any():
+            warnings.warn('This 384 well plate contains merged data with Well names like its row M, '
+                          'the wells M01 to M24 are analyzed as single wells of row M. '
+                          'Export the single well data only if they are merged data')
+
+    return wells.isin(well_names[merged_names])
 
 
 # This function opens a .csv input_IPDA_file that has been exported from the BioRad ddPCR analyzer
-# and exports an excel table that states which samples passed/failed the data quality control tests
-def IPDA_quality_control(input_IPDA_file, minimum_required_droplets):
-
-    # create empty lists for each column of your QC table that you need to use for analysis
-    wells = []
-    samples = []
-    targets = []
-    concentrations = []
-    double_pos = []
-    Ch1_pos = []
-    Ch2_pos = []
-    double_neg = []
-    AcceptedDroplets = []
-    Accepted_droplet_test = []
-    below_thirty_percent_pos_test_passed = []
-
-    # open the input_IPDA_file and add data of interest to lists
-    file_handle = open(input_IPDA_file, 'r')
-    csv_reader = csv.reader(file_handle, delimiter=',')
-    
-    # to skip first row which are just titles the print statement prevents a linter error
-    header_row = next(csv_reader)
-    header_row
-
-    for row in csv_reader:
-        
-        # this is based on the regular output from the ddPCR analyzer
-        wells.append(row[0])
-        samples.append(row[3])
-        targets.append(row[5])
-        concentrations.append(row[7])
-
-        # the droplet channel results and droplet counts will be needed multiple times
-        double_positives = int(row[16])
-        single_channel1 = int(row[17])
-        single_channel2 = int(row[18])
-        double_pos.append(double_positives)
-        negatives = int(row[19])
-        num_droplets = int(row[21])
-        positive_droplets = single_channel1 + single_channel2 + double_positives
-
-        Ch1_pos.append(single_channel1)
-        Ch2_pos.append(single_channel2)
-        double_neg.append(negatives)
-        AcceptedDroplets.append(num_droplets)
-
-        if (num_droplets >= minimum_required_droplets):
-            Accepted_droplet_test.append('passed')
-        else:
-            Accepted_droplet_test.append('failed')
+# and returns the single well data of all Targets, sorted by Sample and Target.
+# Nothing here depends on the minimum_required_droplets, so IPDAInputCache can store the result
+def read_IPDA_plate(input_IPDA_file):
+
+    # read only the columns of interest in one go instead of looping over the rows.
+    # keep_default_na=False makes sure that text like "No Call" (too low concentration) or empty cells
+    # are kept exactly as the ddPCR analyzer exported them instead of being turned into NaN
+    plate = pd.read_csv(input_IPDA_file, header=None, skiprows=1,
+                        usecols=list(IPDA_CSV_COLUMNS), dtype=IPDA_CSV_DTYPES,
+                        keep_default_na=False)
+    plate = plate.rename(columns=IPDA_CSV_COLUMNS)
+
+    # sometimes, people export not just the single well data
+    # but select "Both" single and merged data. So in order to make our program compatible with either file input
+    # we will exclude any merged data if present. Such data has a 'Well' starting with 'M' (see merged_IPDA_wells,
+    # row M of a 384 well plate is kept).
+    # we do this right after reading the file so that we don't run the tests on rows we throw away anyway
+    plate = plate.loc[~merged_IPDA_wells(plate['Well'])]
 
-        if positive_droplets <= 0.3 * (positive_droplets * negatives):
-            below_thirty_percent_pos_test_passed.append('passed')
-        else:
-            below_thirty_percent_pos_test_passed.append('failed')
-
-    file_handle.close()
-
-    # create data frame that will store all data from the quality control
-    quality_control = pd.DataFrame({
-        'Well': wells,
-        'Sample': samples,
-        'Target': targets,
-        'Concentration': concentrations,
-        'Ch1+Ch2+': double_pos,
-        'Ch1+Ch2-': Ch1_pos,
-        'Ch1-Ch2+': Ch2_pos,
-        'Ch1-Ch2-': double_neg,
-        'Number of Droplets': AcceptedDroplets,
-        'More than 10,000 droplets?': Accepted_droplet_test,
-        'Below 30% positives?': below_thirty_percent_pos_test_passed})
-    
     # for better visibility and easier continuation of analysis, sort data
     # so that the same samples and Targets will stick together
-    quality_control = quality_control.sort_values(by=['Sample', 'Target'], axis=0)
+    plate = plate.sort_values(by=['Sample', 'Target'], axis=0)
 
-    # sometimes, people export not just the single well data
-    # but select "Both" single and merged data. So in order to make our program compatible with either file input
-    # we will exclude any merged data if present. Such data has a 'Well' starting with 'M'
-    quality_control = quality_control.loc[~quality_control['Well'].str.contains('M')]
+    return plate
 
-    # export to new Excel file
-    quality_control.to_excel('output_files/Analyzed_IPDA_data.xlsx', sheet_name='Quality Control', index=False)
 
-    return quality_control
+# the columns of the DNA concentration workbooks that the analysis uses
+DNA_CONCENTRATION_COLUMNS = ['Sample', 'DNA conc I used [ng/µL] for RPP30', 'DNA conc I used [ng/µL] for HIV Gag Env reactions']
+# and their dtypes, so that a table without any rows still has numbers to calculate with
+DNA_CONCENTRATION_DTYPES = dict(zip(DNA_CONCENTRATION_COLUMNS, [object, 'float64', 'float64']))
 
 
-# this is where the second function starts. Write an exclude_outliers function that you can call over and over.
+# This function opens the .xlsx file with the DNA concentrations that were used for the RPP30 and HIV reactions of each sample
+def read_DNA_concentrations(DNA_concentrations_used_input_file):
+    with pd.ExcelFile(DNA_concentrations_used_input_file) as DNA_excel_file:
+        return DNA_excel_file.parse('Sheet1')
 
 
-# This function accesses a data frame that contains the quality control of an input_IPDA_file
-# and copies only the samples that passed the data quality control tests
-# it then performs the complete IPDA analysis
-# by correcting the IPDA RPP30 concentration for the actual concentration that the HIV reaction was run at
-# and calculating the % of unsheared DNA
-# using this information, Gag and Env HIV reactions will be normalized
-# Finally Env and Gag data will be combined to calculate the % intact HIV
-# and the HIV copies per million cells
-def IPDA_normalized_to_housekeeping_gene(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets):
+# This function returns the samples of the analyzed data that have no DNA concentrations.
+# These samples can't be normalized and would be left out of the RPP30 and HIV analysis without notice
+def samples_without_DNA_concentrations(analyzed_IPDA_data, DNA_concentration_dataframe):
+    samples = pd.Series(analyzed_IPDA_data['Sample'].unique()).astype(str)
+    return sorted(samples[~samples.isin(DNA_concentration_dataframe['Sample'].astype(str))])
 
-    # use the cleaned and quality controlled dataframe and select only data that passed QC tests, then remove the QC test data
-    analyzed_IPDA_data = IPDA_quality_control(input_IPDA_file, minimum_required_droplets)
-    analyzed_IPDA_data = analyzed_IPDA_data[analyzed_IPDA_data['More than 10,000 droplets?'] == 'passed']
-    # analyzed_IPDA_data = analyzed_IPDA_data[~analyzed_IPDA_data['More than 10,000 droplets?']]
-    analyzed_IPDA_data = analyzed_IPDA_data[analyzed_IPDA_data['Below 30% positives?'] == 'passed']
-    # analyzed_IPDA_data = analyzed_IPDA_data[~analyzed_IPDA_data['Below 30% positives?']]
-    # analyzed_IPDA_data = analyzed_IPDA_data[~analyzed_IPDA_data['Below 30% positives?']]
-    analyzed_IPDA_data = analyzed_IPDA_data.drop(['Number of Droplets', 'More than 10,000 droplets?', 'Below 30% positives?'], axis=1)
-    # somehow, 'Concentration' is an object instead of a number, so we need to convert it to float
-    # sometimes the ddPCR Machine outputs the text "No Call" if the concentration is too low.
-    # "No Call" cannot be converted to float, that's why we turn this into a 0
-    analyzed_IPDA_data['Concentration'].replace('No Call', '0', inplace=True)
-    analyzed_IPDA_data['Concentration'] = analyzed_IPDA_data['Concentration'].astype(float)
-    # split dataframe into 4 new dataframes, one for each Target used
-    rpp30_fam_df = analyzed_IPDA_data.loc[analyzed_IPDA_data['Target'].str.contains('Rpp30 Fam|Rpp30 Shear', case=False, flags=re.IGNORECASE, regex=True)]
-    rpp30_vic_df = analyzed_IPDA_data.loc[analyzed_IPDA_data['Target'].str.contains('vic', case=False, flags=re.IGNORECASE, regex=True)]
-    gag_df = analyzed_IPDA_data.loc[analyzed_IPDA_data['Target'].str.contains('Psi|Gag', case=False, flags=re.IGNORECASE, regex=True)]
-    env_df = analyzed_IPDA_data.loc[analyzed_IPDA_data['Target'].str.contains('env', case=False, flags=re.IGNORECASE, regex=True)]
-    # correct RPP30 concentration for HIV concentration
-    DNA_excel_file = pd.ExcelFile(DNA_concentrations_used_input_file)
-    DNA_concentration_dataframe = DNA_excel_file.parse('Sheet1')
 
-    # we merge the dataframe of the DNAconcentration_input_file
-    rpp30_fam_df = pd.merge(rpp30_fam_df, DNA_concentration_dataframe, on='Sample')
+# This function opens a .csv input_IPDA_file that has been exported from the BioRad ddPCR analyzer
+# and exports an excel table that states which samples passed/failed the data quality control tests.
+# If an IPDAResults object is given, the table is added to it instead and saved later together with all other sheets.
+# If an IPDAInputCache is given, a .csv file that was read before is loaded from the cache instead.
+# If an IPDAStageRecorder is given, reading the file and the quality control are recorded as two stages
+def IPDA_quality_control(input_IPDA_file, minimum_required_droplets, output_directory='output_files', results=None,
+                         cache=None, recorder=None):
+
+    if recorder is None:
+        recorder = NULL_STAGE_RECORDER
+
+    with recorder.stage('Read plate') as stage:
+        if cache is None:
+            quality_control = read_IPDA_plate(input_IPDA_file)
+        else:
+            quality_control = cache.read_IPDA_plate(input_IPDA_file)
+        stage.rows = len(quality_control)
+
+    with recorder.stage('Quality Control') as stage:
+        quality_control = _quality_control_tests(quality_control, minimum_required_droplets)
+        stage.rows = len(quality_control)
+
+    # export to new Excel file, unless the rest of the analysis still adds its sheets to the same results
+    write_results = results is None
+    if write_results:
+        results = IPDAResults()
+    results.add_sheet('Quality Control', quality_control)
+    if write_results:
+        with recorder.stage('Write results') as stage:
+            results.write(output_directory)
+            stage.rows = len(quality_control)
 
-    # Now we can correct the concentration values from the old rpp30_fam_df
-    # using the two new columns that we got from the DNA_concentration_dataframe
-    actual_fam_conc = (rpp30_fam_df['Concentration'] / rpp30_fam_df['DNA conc I used [ng/µL] for RPP30'])
-    dilution_factor = actual_fam_conc * rpp30_fam_df['DNA conc I used [ng/µL] for HIV Gag Env reactions']
-    rpp30_fam_df['Corrected concentration [ng/µL]'] = dilution_factor
-    
-    # perform the same DNA correction steps on the rpp30_vic_df
-    rpp30_vic_df = pd.merge(rpp30_vic_df, DNA_concentration_dataframe, on='Sample')
-    actual_vic_conc = (rpp30_vic_df['Concentration'] / rpp30_vic_df['DNA conc I used [ng/µL] for RPP30'])
-    rpp30_vic_df['Corrected concentration [ng/µL]'] = actual_vic_conc * rpp30_vic_df['DNA conc I used [ng/µL] for HIV Gag Env reactions']
-    
-    # drop the columns that you don't need anymore
-    rpp30_fam_df = rpp30_fam_df.drop(['DNA conc I used [ng/µL] for RPP30', 'DNA conc I used [ng/µL] for HIV Gag Env reactions'], axis=1)
-    rpp30_vic_df = rpp30_vic_df.drop(['DNA conc I used [ng/µL] for RPP30', 'DNA conc I used [ng/µL] for HIV Gag Env reactions'], axis=1)
+    return quality_control
 
-    # now using the corrected concentrations, we will combine the data of the rpp30_fam_df and  rpp30_vic_df
-    # to find the average concentrations, as well as the %unsheared DNA
-    # which is the fraction of double positive droplets
-    # for this, we first need to take the mean of the corrected concentrations of each replicate
-    # to combine the data of all replicates for one given sample
-    rpp30_combined_df = pd.merge(rpp30_fam_df, rpp30_vic_df, on=['Well', 'Sample'], suffixes=['_fam', '_vic'])
-    dataframe_for_rpp30_means = rpp30_combined_df.groupby(['Sample'], as_index=False).mean(numeric_only=True)
-    dataframe_for_rpp30_means = dataframe_for_rpp30_means[['Sample', 'Corrected concentration [ng/µL]_fam', 'Corrected concentration [ng/µL]_vic']]
-    dataframe_for_rpp30_stdevs = rpp30_combined_df.groupby(['Sample'], as_index=False).std(numeric_only=True)
-    dataframe_for_rpp30_stdevs = dataframe_for_rpp30_stdevs[['Sample', 'Corrected concentration [ng/µL]_fam', 'Corrected concentration [ng/µL]_vic']]
-
-    # now that we have the average and stdev for each corrected concentration, let's rename the columns
-    # and then merge all three dataframes so that we have single replicate data, means, and stdevs in one dataframe
-    dataframe_for_rpp30_means = dataframe_for_rpp30_means.rename(columns={'Corrected concentration [ng/µL]_fam': 'fam_mean'})
-    dataframe_for_rpp30_means = dataframe_for_rpp30_means.rename(columns={'Corrected concentration [ng/µL]_vic': 'vic_mean'})
-    dataframe_for_rpp30_stdevs = dataframe_for_rpp30_stdevs.rename(columns={'Corrected concentration [ng/µL]_fam': 'fam_stdev'})
-    dataframe_for_rpp30_stdevs = dataframe_for_rpp30_stdevs.rename(columns={'Corrected concentration [ng/µL]_vic': 'vic_stdev'})
-    rpp30_combined_df = pd.merge(rpp30_combined_df, dataframe_for_rpp30_means, on=['Sample'])
-    rpp30_combined_df = pd.merge(rpp30_combined_df, dataframe_for_rpp30_stdevs, on=['Sample'])
-
-    # For each Sample, check for outliers where the 'Corrected concentration [ng/µL]' is outside of mean±(2*stDev) and exclude those
-    # test for each row if it's outside the mean±2*StDev range for that sample
-    fam_lower = (rpp30_combined_df['fam_mean'] - (rpp30_combined_df['fam_stdev']) * 2)
-    fam_upper = (rpp30_combined_df['fam_mean'] + (rpp30_combined_df['fam_stdev']) * 2)
-    fam_test1 = rpp30_combined_df['Corrected concentration [ng/µL]_fam'] >= fam_lower
-    fam_test2 = rpp30_combined_df['Corrected concentration [ng/µL]_fam'] <= fam_upper
-    vic_lower = (rpp30_combined_df['vic_mean'] - (rpp30_combined_df['vic_stdev']) * 2)
-    vic_upper = (rpp30_combined_df['vic_mean'] + (rpp30_combined_df['vic_stdev']) * 2)
-    vic_test1 = rpp30_combined_df['Corrected concentration [ng/µL]_vic'] >= vic_lower
-    vic_test2 = rpp30_combined_df['Corrected concentration [ng/µL]_vic'] <= vic_upper
-    rpp30_combined_df['Outlier_test passed'] = fam_test1 & fam_test2 & vic_test1 & vic_test2
-    rpp30_combined_df['Outlier_test passed'] = rpp30_combined_df['Outlier_test passed'].map({True: 'passed', False: 'failed'})
+
+# adds the 'More than 10,000 droplets?' and 'Below 30% positives?' test results to the table of a plate
+def _quality_control_tests(quality_control, minimum_required_droplets):
+
+    # the droplet tests are calculated on the whole columns at once
+    positive_droplets = quality_control['Ch1+Ch2+'] + quality_control['Ch1+Ch2-'] + quality_control['Ch1-Ch2+']
+    negatives = quality_control['Ch1-Ch2-']
+    droplet_test = quality_control['Number of Droplets'] >= minimum_required_droplets
+    thirty_percent_test = positive_droplets <= 0.3 * (positive_droplets * negatives)
+    quality_control['More than 10,000 droplets?'] = np.where(droplet_test, 'passed', 'failed')
+    quality_control['Below 30% positives?'] = np.where(thirty_percent_test, 'passed', 'failed')
+    return quality_control
+
+
+# This function finds the assay role ('RPP30 fam', 'RPP30 vic', 'Gag' or 'Env') of each Target.
+# instead of searching every row of the plate, each different Target name is searched once
+# and the result is copied to all rows with that Target.
+# Returns a categorical Series with the roles, NaN for Targets without role
+def classify_IPDA_targets(targets, target_roles=IPDA_TARGET_ROLES):
+
+    targets = targets.astype('category')
+    role_of_target = {}
+    for target in targets.cat.categories:
+        role_of_target[target] = np.nan
+        for role, pattern in target_roles.items():
+            if re.search(pattern, target, flags=re.IGNORECASE):
+                role_of_target[target] = role
+                break
+
+    roles = targets.map(role_of_target).astype(pd.CategoricalDtype(list(target_roles)))
+    return roles
+
+
+# This function performs the outlier exclusion that both the RPP30 and the HIV analysis need.
+# For each Sample, a replicate is an outlier if any of the tested_columns is outside of mean±(sd_multiplier*stDev)
+# of all replicates of that Sample.
+# tested_columns maps every tested column to the short name that is used for its mean and stdev columns,
+# e.g. {'Corrected concentration [ng/µL]_fam': 'fam'} adds the columns 'fam_mean' and 'fam_stdev'.
+# The means and stdevs are calculated with groupby().transform, so they line up with the replicates
+# and don't have to be merged back onto the dataframe.
+# Returns a copy of the dataframe with the mean, stdev and 'Outlier_test passed' ('passed' or 'failed') columns added
+def exclude_outliers(dataframe, tested_columns, sd_multiplier=2, group_column='Sample'):
+
+    columns = list(tested_columns)
+    replicates = dataframe.groupby(group_column, observed=True, sort=False)[columns]
+    means = replicates.transform('mean')
+    stdevs = replicates.transform('std')
+
+    # test for each row if it's inside the mean±sd_multiplier*StDev range for that sample, for all tested columns at once.
+    # a Sample with only one replicate has no stdev (NaN), so its replicate fails the test
+    values = dataframe[columns]
+    inside_lower = values >= means - stdevs * sd_multiplier
+    inside_upper = values <= means + stdevs * sd_multiplier
+    passed = (inside_lower & inside_upper).all(axis=1)
+
+    dataframe = dataframe.copy()
+    for column in columns:
+        dataframe[tested_columns[column] + '_mean'] = means[column]
+    for column in columns:
+        dataframe[tested_columns[column] + '_stdev'] = stdevs[column]
+    dataframe['Outlier_test passed'] = np.where(passed, 'passed', 'failed')
+
+    return dataframe
+
+
+# the ways IPDA_normalized_to_housekeeping_gene can bring the RPP30, Gag and Env data of each well together:
+# 'merge' splits the plate into one dataframe per Target and merges them back together,
+# 'wide' turns the plate into one wide table with one row per well and calculates everything column by column,
+# 'verify' runs both and checks that they give the same results
+NORMALIZATION_ENGINES = ('merge', 'wide', 'verify')
+
+# the data of each Target that goes into the RPP30 Analysis and HIV Analysis tables
+IPDA_TARGET_COLUMNS = ['Target', 'Concentration', 'Ch1+Ch2+', 'Ch1+Ch2-', 'Ch1-Ch2+', 'Ch1-Ch2-']
+IPDA_DROPLET_COLUMNS = ['Ch1+Ch2+', 'Ch1+Ch2-', 'Ch1-Ch2+', 'Ch1-Ch2-']
+
+
+# This function takes the table with the fam and vic data of each RPP30 well next to each other
+# (columns ending in _fam and _vic, including the 'Corrected concentration [ng/µL]' of both channels),
+# excludes outliers and calculates the Average RPP30 and %Unsheared of each sample.
+# Returns the 'RPP30 Analysis' table and the table with the means of each sample
+def _RPP30_outliers_and_means(rpp30_combined_df, outlier_sd_multiplier):
+
+    # For each Sample, check for outliers where the 'Corrected concentration [ng/µL]' is outside of mean±(2*stDev) and exclude those.
+    # this adds the means and stdevs of each sample next to the single replicate data
+    rpp30_combined_df = exclude_outliers(rpp30_combined_df, {'Corrected concentration [ng/µL]_fam': 'fam',
+                                                             'Corrected concentration [ng/µL]_vic': 'vic'}, outlier_sd_multiplier)
     rpp30_combined_df = rpp30_combined_df.drop(['Ch1+Ch2+_vic', 'Ch1+Ch2-_vic', 'Ch1-Ch2+_vic', 'Ch1-Ch2-_vic'], axis=1)
     rpp30_combined_df = rpp30_combined_df.rename(columns={'Ch1+Ch2+_fam': 'Ch1+Ch2+'})
     rpp30_combined_df = rpp30_combined_df.rename(columns={'Ch1+Ch2-_fam': 'Ch1+Ch2-'})
@@ -189,7 +258,7 @@ def IPDA_normalized_to_housekeeping_gene(input_IPDA_file, DNA_concentrations_use
     no_outliers = rpp30_combined_df[rpp30_combined_df['Outlier_test passed'] == 'passed']
 
     no_outliers = no_outliers[['Sample', 'Ch1+Ch2+', 'Ch1+Ch2-', 'Ch1-Ch2+', 'Corr conc fam', 'Corr conc vic']]
-    dataframe_for_rpp30_means = no_outliers.groupby('Sample', as_index=False).mean(numeric_only=True)
+    dataframe_for_rpp30_means = no_outliers.groupby('Sample', as_index=False, observed=True).mean(numeric_only=True)
     
     average_shear_vic = (dataframe_for_rpp30_means['Corr conc fam'] + dataframe_for_rpp30_means['Corr conc vic']) / 2
     dataframe_for_rpp30_means['Average RPP30'] = average_shear_vic
@@ -200,17 +269,17 @@ def IPDA_normalized_to_housekeeping_gene(input_IPDA_file, DNA_concentrations_use
     # the values are very similar, however, and do not affect the final result
     unsheared = d_pos_vic / (d_pos_vic + ((dataframe_for_rpp30_means['Ch1+Ch2-'] + dataframe_for_rpp30_means['Ch1-Ch2+']) / 2))
     dataframe_for_rpp30_means['%Unsheared averaged'] = unsheared
-
-    # now that we have done all the calculations that required us to work on each sample individually
-    # we can add the two new columns to our original rpp30_combined_df that shows all technical replicates
-    # also add the concentration from the env table to gag for later calculations
-    env_df = env_df[['Well', 'Sample', 'Concentration']]
-    env_df = env_df.rename(columns={'Concentration': 'Env conc'})
-    gag_df = gag_df.rename(columns={'Concentration': 'Gag conc'})
-    gag_df = pd.merge(gag_df, env_df, on=['Well', 'Sample'])
     dataframe_for_rpp30_means = dataframe_for_rpp30_means[['Sample', 'Average RPP30', '%Unsheared averaged']]
-    gag_df = pd.merge(gag_df, dataframe_for_rpp30_means, on=['Sample'])
-    
+
+    return rpp30_combined_df, dataframe_for_rpp30_means
+
+
+# This function takes the table with the Gag and Env concentrations of each HIV well
+# next to the Average RPP30 and %Unsheared of its sample,
+# calculates the copies per million cells, excludes outliers and calculates the intact HIV.
+# Returns the 'HIV Analysis' table and the table with the intact HIV of all replicates that are no outliers
+def _HIV_copies_per_million(gag_df, outlier_sd_multiplier):
+
     # we calculate the 3'Deleted copies per million CD4+ T cells
     # by multiplying the concentration by 1 million
     # and correcting for the actual number of copies we expect per cell compared to copies of RPP30
@@ -225,30 +294,8 @@ def IPDA_normalized_to_housekeeping_gene(input_IPDA_file, DNA_concentrations_use
     # at this stage, we are going to perform an outlier exclusion step
     # to exclude any rows in which gag_df["3'Deleted/hypermutated/M (Gag/M)"] or gag_df["5'Deleted/M (Env/M)"]
     # are more than 2 standard deviations away from the mean
-    dataframe_HIV_means = gag_df.groupby(['Sample'], as_index=False).mean(numeric_only=True)
-    dataframe_HIV_means = dataframe_HIV_means[['Sample', "3'Deleted/hypermutated/M (Gag/M)", "5'Deleted/M (Env/M)"]]
-    dataframe_HIV_means = dataframe_HIV_means.rename(columns={"3'Deleted/hypermutated/M (Gag/M)": 'Gag/M_mean'})
-    dataframe_HIV_means = dataframe_HIV_means.rename(columns={"5'Deleted/M (Env/M)": 'Env/M_mean'})
-    dataframe_HIV_stdev = gag_df.groupby(['Sample'], as_index=False).std(numeric_only=True)
-    dataframe_HIV_stdev = dataframe_HIV_stdev[['Sample', "3'Deleted/hypermutated/M (Gag/M)", "5'Deleted/M (Env/M)"]]
-    dataframe_HIV_stdev = dataframe_HIV_stdev.rename(columns={"3'Deleted/hypermutated/M (Gag/M)": 'Gag/M_stdev'})
-    dataframe_HIV_stdev = dataframe_HIV_stdev.rename(columns={"5'Deleted/M (Env/M)": 'Env/M_stdev'})
-
-    gag_df = pd.merge(gag_df, dataframe_HIV_means, on=['Sample'])
-    gag_df = pd.merge(gag_df, dataframe_HIV_stdev, on=['Sample'])
-
-    # For each Sample, check for outliers where the '3'Deleted/hypermutated/M (Gag/M)' or the  "5'Deleted/M (Env/M)"
-    # are outside of mean±(2*stDev) and exclude those
-    gag_lower = (gag_df['Gag/M_mean'] - (gag_df['Gag/M_stdev']) * 2)
-    gag_upper = (gag_df['Gag/M_mean'] + (gag_df['Gag/M_stdev']) * 2)
-    gag_test1 = gag_df["3'Deleted/hypermutated/M (Gag/M)"] >= gag_lower
-    gag_test2 = gag_df["3'Deleted/hypermutated/M (Gag/M)"] <= gag_upper
-    env_lower = (gag_df['Env/M_mean'] - (gag_df['Env/M_stdev']) * 2)
-    env_upper = (gag_df['Env/M_mean'] + (gag_df['Env/M_stdev']) * 2)
-    env_test1 = gag_df["5'Deleted/M (Env/M)"] >= env_lower
-    env_test2 = gag_df["5'Deleted/M (Env/M)"] <= env_upper
-    gag_df['Outlier_test passed'] = gag_test1 & gag_test2 & env_test1 & env_test2
-    gag_df['Outlier_test passed'] = gag_df['Outlier_test passed'].map({True: 'passed', False: 'failed'})
+    gag_df = exclude_outliers(gag_df, {"3'Deleted/hypermutated/M (Gag/M)": 'Gag/M',
+                                       "5'Deleted/M (Env/M)": 'Env/M'}, outlier_sd_multiplier)
     no_HIV_outliers = gag_df[gag_df['Outlier_test passed'] == 'passed']
 
     # to later calculate the % and number of intact HIV, per million cells, we will need to know
@@ -278,42 +325,403 @@ def IPDA_normalized_to_housekeeping_gene(input_IPDA_file, DNA_concentrations_use
     no_HIV_outliers = no_HIV_outliers.rename(columns={'intact concentration': 'non-corr. intact conc.'})
     no_HIV_outliers = no_HIV_outliers.drop(['Well', 'Target'], axis=1)
 
-    # save new dataframes to Excel file
-    with pd.ExcelWriter('output_files/Analyzed_IPDA_data.xlsx', engine='openpyxl', mode='a') as writer:
-        rpp30_combined_df.to_excel(writer, sheet_name='RPP30 Analysis', index=False)
-        gag_df.to_excel(writer, sheet_name='HIV Analysis', index=False)
+    return gag_df, no_HIV_outliers
+
+
+# This is the RPP30 step of the 'merge' engine of IPDA_normalized_to_housekeeping_gene.
+# It takes the fam and vic Targets of the quality controlled plate and merges them with the DNA concentrations
+# and with each other by well and sample.
+# Returns the 'RPP30 Analysis' table and the table with the means of each sample
+def _RPP30_analysis_with_merges(analyzed_IPDA_data, assay_roles, DNA_concentration_dataframe, outlier_sd_multiplier):
+
+    # split dataframe into new dataframes, one for each Target used.
+    # the Targets are classified only once, then each dataframe is a simple comparison with its role
+    rpp30_fam_df = analyzed_IPDA_data.loc[assay_roles == 'RPP30 fam']
+    rpp30_vic_df = analyzed_IPDA_data.loc[assay_roles == 'RPP30 vic']
+
+    # correct RPP30 concentration for HIV concentration
+    # we merge the dataframe of the DNAconcentration_input_file
+    rpp30_fam_df = pd.merge(rpp30_fam_df, DNA_concentration_dataframe, on='Sample')
+
+    # Now we can correct the concentration values from the old rpp30_fam_df
+    # using the two new columns that we got from the DNA_concentration_dataframe
+    actual_fam_conc = (rpp30_fam_df['Concentration'] / rpp30_fam_df['DNA conc I used [ng/µL] for RPP30'])
+    dilution_factor = actual_fam_conc * rpp30_fam_df['DNA conc I used [ng/µL] for HIV Gag Env reactions']
+    rpp30_fam_df['Corrected concentration [ng/µL]'] = dilution_factor
+    
+    # perform the same DNA correction steps on the rpp30_vic_df
+    rpp30_vic_df = pd.merge(rpp30_vic_df, DNA_concentration_dataframe, on='Sample')
+    actual_vic_conc = (rpp30_vic_df['Concentration'] / rpp30_vic_df['DNA conc I used [ng/µL] for RPP30'])
+    rpp30_vic_df['Corrected concentration [ng/µL]'] = actual_vic_conc * rpp30_vic_df['DNA conc I used [ng/µL] for HIV Gag Env reactions']
+    
+    # drop the columns that you don't need anymore
+    rpp30_fam_df = rpp30_fam_df.drop(['DNA conc I used [ng/µL] for RPP30', 'DNA conc I used [ng/µL] for HIV Gag Env reactions'], axis=1)
+    rpp30_vic_df = rpp30_vic_df.drop(['DNA conc I used [ng/µL] for RPP30', 'DNA conc I used [ng/µL] for HIV Gag Env reactions'], axis=1)
+
+    # now using the corrected concentrations, we will combine the data of the rpp30_fam_df and  rpp30_vic_df
+    # to find the average concentrations, as well as the %unsheared DNA
+    # which is the fraction of double positive droplets
+    # for this, we first need to take the mean of the corrected concentrations of each replicate
+    # to combine the data of all replicates for one given sample
+    rpp30_combined_df = pd.merge(rpp30_fam_df, rpp30_vic_df, on=['Well', 'Sample'], suffixes=['_fam', '_vic'])
+    return _RPP30_outliers_and_means(rpp30_combined_df, outlier_sd_multiplier)
+
+
+# This is the HIV step of the 'merge' engine of IPDA_normalized_to_housekeeping_gene.
+# It merges the Gag and Env Targets of the quality controlled plate by well and sample
+# and adds the RPP30 means of each sample.
+# Returns the 'HIV Analysis' table and the intact HIV table
+def _HIV_analysis_with_merges(analyzed_IPDA_data, assay_roles, dataframe_for_rpp30_means, outlier_sd_multiplier):
+
+    gag_df = analyzed_IPDA_data.loc[assay_roles == 'Gag']
+    env_df = analyzed_IPDA_data.loc[assay_roles == 'Env']
+
+    # now that we have done all the calculations that required us to work on each sample individually
+    # we can add the two new columns to our original rpp30_combined_df that shows all technical replicates
+    # also add the concentration from the env table to gag for later calculations
+    env_df = env_df[['Well', 'Sample', 'Concentration']]
+    env_df = env_df.rename(columns={'Concentration': 'Env conc'})
+    gag_df = gag_df.rename(columns={'Concentration': 'Gag conc'})
+    gag_df = pd.merge(gag_df, env_df, on=['Well', 'Sample'])
+    gag_df = pd.merge(gag_df, dataframe_for_rpp30_means, on=['Sample'])
+
+    return _HIV_copies_per_million(gag_df, outlier_sd_multiplier)
+
+
+# This function turns the quality controlled plate (one row per Target and well)
+# into one wide table with one row per (Sample, Well) and one block of columns per assay role,
+# e.g. wide_table['Gag']['Concentration'] is the Gag concentration of every well.
+# The 'Row' column of each block remembers where that Target was in the quality controlled table,
+# so that the results can be put in the same order as the 'merge' engine puts them.
+# Each well can have only one Target per assay role. Merged multi-plate exports can have the same sample
+# in the same well on two plates, such wells raise a ValueError (the 'merge' engine combines every pair of their rows)
+def build_wide_IPDA_table(analyzed_IPDA_data, assay_roles):
+
+    long_table = analyzed_IPDA_data[['Sample', 'Well'] + IPDA_TARGET_COLUMNS]
+    long_table = long_table.assign(**{'Assay role': assay_roles, 'Row': np.arange(len(long_table))})
+    long_table = long_table[long_table['Assay role'].notna()]
+
+    duplicated_wells = long_table.duplicated(['Sample', 'Well', 'Assay role'])
+    if duplicated_wells.any():
+        duplicates = long_table.loc[duplicated_wells, ['Sample', 'Well']].astype(str).drop_duplicates().sort_values(['Sample', 'Well'])
+        raise ValueError("The 'wide' engine needs one Target per assay role in each well, but these wells have more: "
+                         + ', '.join(duplicates['Sample'] + ' in ' + duplicates['Well'])
+                         + ". Use engine='merge' for plates with the same sample in the same well more than once")
+
+    wide_table = long_table.set_index(['Sample', 'Well', 'Assay role']).unstack('Assay role')
+    wide_table = wide_table.swaplevel(axis=1)
+
+    # a plate without any Targets of one role still gets (empty) columns for it
+    all_columns = pd.MultiIndex.from_product([list(IPDA_TARGET_ROLES), IPDA_TARGET_COLUMNS + ['Row']])
+    wide_table = wide_table.reindex(columns=all_columns)
+
+    return wide_table
+
+
+# This function selects the wells of the wide table that have both RPP30 fam and vic data
+# and a DNA concentration, and lays them out like the merged fam and vic table of the 'merge' engine,
+# including the 'Corrected concentration [ng/µL]' of both channels
+def _RPP30_table_from_wide(wide_table, DNA_concentration_dataframe):
+
+    DNA_concentrations = DNA_concentration_dataframe.set_index('Sample')
+    samples = wide_table.index.get_level_values('Sample')
+    complete_wells = (wide_table[('RPP30 fam', 'Row')].notna() & wide_table[('RPP30 vic', 'Row')].notna()
+                      & samples.isin(DNA_concentrations.index))
+    rpp30_wide = wide_table[complete_wells].sort_values(('RPP30 fam', 'Row'))
+
+    # look up the DNA concentrations of each well's sample once for both channels
+    samples = rpp30_wide.index.get_level_values('Sample').astype(object)
+    rpp30_DNA_conc = DNA_concentrations['DNA conc I used [ng/µL] for RPP30'].reindex(samples).to_numpy()
+    HIV_DNA_conc = DNA_concentrations['DNA conc I used [ng/µL] for HIV Gag Env reactions'].reindex(samples).to_numpy()
+
+    rpp30_combined_df = {'Well': rpp30_wide.index.get_level_values('Well'),
+                         'Sample': rpp30_wide.index.get_level_values('Sample')}
+    for role, suffix in [('RPP30 fam', '_fam'), ('RPP30 vic', '_vic')]:
+        block = rpp30_wide[role]
+        for column in IPDA_TARGET_COLUMNS:
+            rpp30_combined_df[column + suffix] = block[column].to_numpy()
+        actual_conc = block['Concentration'].to_numpy() / rpp30_DNA_conc
+        rpp30_combined_df['Corrected concentration [ng/µL]' + suffix] = actual_conc * HIV_DNA_conc
+    rpp30_combined_df = pd.DataFrame(rpp30_combined_df)
+
+    # the droplet counts became floats while the roles without data were still empty
+    droplet_columns = [column + suffix for suffix in ['_fam', '_vic'] for column in IPDA_DROPLET_COLUMNS]
+    return rpp30_combined_df.astype({column: 'int32' for column in droplet_columns})
+
+
+# This function selects the wells of the wide table that have both Gag and Env data
+# and a sample with RPP30 means, and lays them out like the merged Gag and Env table of the 'merge' engine
+def _HIV_table_from_wide(wide_table, dataframe_for_rpp30_means):
+
+    rpp30_means = dataframe_for_rpp30_means.set_index('Sample')
+    samples = wide_table.index.get_level_values('Sample')
+    complete_wells = (wide_table[('Gag', 'Row')].notna() & wide_table[('Env', 'Row')].notna()
+                      & samples.isin(rpp30_means.index))
+    HIV_wide = wide_table[complete_wells].sort_values(('Gag', 'Row'))
+    samples = HIV_wide.index.get_level_values('Sample')
+
+    gag_block = HIV_wide['Gag']
+    gag_df = {'Well': HIV_wide.index.get_level_values('Well'),
+              'Sample': samples,
+              'Target': gag_block['Target'].to_numpy(),
+              'Gag conc': gag_block['Concentration'].to_numpy()}
+    for column in IPDA_DROPLET_COLUMNS:
+        gag_df[column] = gag_block[column].to_numpy()
+    gag_df['Env conc'] = HIV_wide[('Env', 'Concentration')].to_numpy()
+    gag_df['Average RPP30'] = rpp30_means['Average RPP30'].reindex(samples).to_numpy()
+    gag_df['%Unsheared averaged'] = rpp30_means['%Unsheared averaged'].reindex(samples).to_numpy()
+
+    return pd.DataFrame(gag_df).astype({column: 'int32' for column in IPDA_DROPLET_COLUMNS})
+
+
+# This function makes sure a table that is looked up by Sample has only one row per Sample.
+# The 'merge' engine would count every well of a sample with two rows twice and the 'wide' engine can't look them up,
+# so for both engines only the first row of each Sample is used, and the duplicated samples are reported with a warning
+def _one_row_per_sample(dataframe, table_name):
+    duplicated_rows = dataframe['Sample'].duplicated()
+    if not duplicated_rows.any():
+        return dataframe
+    duplicated_samples = sorted(dataframe.loc[duplicated_rows, 'Sample'].astype(str).unique())
+    warnings.warn('The ' + table_name + ' have more than one row for the samples ' + ', '.join(duplicated_samples)
+                  + ', only the first row of each sample is used')
+    return dataframe[~duplicated_rows]
+
+
+# This function performs the RPP30 step of the IPDA analysis on the data that passed the quality control:
+# it corrects the RPP30 concentrations for the DNA concentrations, excludes outliers
+# and calculates the Average RPP30 and %Unsheared of each sample.
+# Without wide_table, the 'merge' engine is used. With a wide_table from build_wide_IPDA_table,
+# the 'wide' engine calculates the same on the columns of that table.
+# Returns the 'RPP30 Analysis' table and the table with the means of each sample
+def IPDA_RPP30_analysis(analyzed_IPDA_data, assay_roles, DNA_concentration_dataframe, outlier_sd_multiplier=2, wide_table=None):
+
+    DNA_concentration_dataframe = _one_row_per_sample(DNA_concentration_dataframe, 'DNA concentrations')
+    if wide_table is None:
+        return _RPP30_analysis_with_merges(analyzed_IPDA_data, assay_roles, DNA_concentration_dataframe, outlier_sd_multiplier)
+
+    rpp30_combined_df = _RPP30_table_from_wide(wide_table, DNA_concentration_dataframe)
+    return _RPP30_outliers_and_means(rpp30_combined_df, outlier_sd_multiplier)
+
+
+# This function performs the HIV step of the IPDA analysis:
+# it normalizes the Gag and Env concentrations to the RPP30 means of each sample, excludes outliers
+# and calculates the intact HIV. wide_table chooses the engine just like in IPDA_RPP30_analysis.
+# Returns the 'HIV Analysis' table and the intact HIV table
+def IPDA_HIV_analysis(analyzed_IPDA_data, assay_roles, dataframe_for_rpp30_means, outlier_sd_multiplier=2, wide_table=None):
+
+    dataframe_for_rpp30_means = _one_row_per_sample(dataframe_for_rpp30_means, 'RPP30 means')
+    if wide_table is None:
+        return _HIV_analysis_with_merges(analyzed_IPDA_data, assay_roles, dataframe_for_rpp30_means, outlier_sd_multiplier)
+
+    gag_df = _HIV_table_from_wide(wide_table, dataframe_for_rpp30_means)
+    return _HIV_copies_per_million(gag_df, outlier_sd_multiplier)
+
+
+# This function runs the RPP30 and HIV steps with the 'merge' engine, or with the 'wide' engine if use_wide_table is True.
+# Returns the 'RPP30 Analysis' table, the 'HIV Analysis' table and the intact HIV table
+def _normalize(analyzed_IPDA_data, assay_roles, DNA_concentration_dataframe, outlier_sd_multiplier, use_wide_table,
+               recorder=NULL_STAGE_RECORDER):
+
+    with recorder.stage('RPP30 normalization') as stage:
+        wide_table = None
+        if use_wide_table:
+            wide_table = build_wide_IPDA_table(analyzed_IPDA_data, assay_roles)
+
+        rpp30_combined_df, dataframe_for_rpp30_means = IPDA_RPP30_analysis(analyzed_IPDA_data, assay_roles, DNA_concentration_dataframe,
+                                                                          outlier_sd_multiplier, wide_table)
+        stage.rows = len(rpp30_combined_df)
+
+    with recorder.stage('HIV analysis') as stage:
+        gag_df, no_HIV_outliers = IPDA_HIV_analysis(analyzed_IPDA_data, assay_roles, dataframe_for_rpp30_means,
+                                                    outlier_sd_multiplier, wide_table)
+        stage.rows = len(gag_df)
+
+    return rpp30_combined_df, gag_df, no_HIV_outliers
+
+
+# This function checks that the 'merge' and the 'wide' engine calculated the same tables.
+# The dtypes of Well, Sample and Target can differ (categories or strings), their values can't
+def _check_normalization_engines_match(merge_tables, wide_tables):
+
+    table_names = ['RPP30 Analysis', 'HIV Analysis', 'intact HIV']
+    for table_name, merge_table, wide_table in zip(table_names, merge_tables, wide_tables):
+        tables = []
+        for table in [merge_table, wide_table]:
+            table = table.reset_index(drop=True)
+            categorical_columns = table.select_dtypes('category').columns
+            tables.append(table.astype({column: object for column in categorical_columns}))
+        try:
+            pd.testing.assert_frame_equal(tables[0], tables[1], check_dtype=False)
+        except AssertionError as error:
+            raise AssertionError('The wide table engine gave a different ' + table_name + ' table than the merge engine:\n'
+                                 + str(error))
+
+
+# This function selects the data of the quality control table that passed the data quality control tests
+# and prepares it for the analysis. Returns the passed data and the assay role of each of its rows
+def passed_IPDA_data(quality_control, target_roles=IPDA_TARGET_ROLES):
+
+    analyzed_IPDA_data = quality_control[quality_control['More than 10,000 droplets?'] == 'passed']
+    # analyzed_IPDA_data = analyzed_IPDA_data[~analyzed_IPDA_data['More than 10,000 droplets?']]
+    analyzed_IPDA_data = analyzed_IPDA_data[analyzed_IPDA_data['Below 30% positives?'] == 'passed']
+    # analyzed_IPDA_data = analyzed_IPDA_data[~analyzed_IPDA_data['Below 30% positives?']]
+    # analyzed_IPDA_data = analyzed_IPDA_data[~analyzed_IPDA_data['Below 30% positives?']]
+    analyzed_IPDA_data = analyzed_IPDA_data.drop(['Number of Droplets', 'More than 10,000 droplets?', 'Below 30% positives?'], axis=1)
+    # somehow, 'Concentration' is an object instead of a number, so we need to convert it to float
+    # sometimes the ddPCR Machine outputs the text "No Call" if the concentration is too low.
+    # "No Call" cannot be converted to float, that's why we turn this into a 0
+    # (IPDA_quality_control keeps the text exactly as exported, so we convert the whole column here in one step)
+    analyzed_IPDA_data['Concentration'] = analyzed_IPDA_data['Concentration'].replace('No Call', '0').astype(float)
+    analyzed_IPDA_data = analyzed_IPDA_data.astype(IPDA_COMPACT_DTYPES)
+    assay_roles = classify_IPDA_targets(analyzed_IPDA_data['Target'], target_roles)
+
+    return analyzed_IPDA_data, assay_roles
+
+
+# This function accesses a data frame that contains the quality control of an input_IPDA_file
+# and copies only the samples that passed the data quality control tests
+# it then performs the complete IPDA analysis
+# by correcting the IPDA RPP30 concentration for the actual concentration that the HIV reaction was run at
+# and calculating the % of unsheared DNA
+# using this information, Gag and Env HIV reactions will be normalized
+# Finally Env and Gag data will be combined to calculate the % intact HIV
+# and the HIV copies per million cells.
+# Replicates outside of mean±(outlier_sd_multiplier*stDev) of their Sample are excluded in both steps.
+# target_roles decides which Targets are RPP30 fam, RPP30 vic, Gag and Env (see IPDA_TARGET_ROLES).
+# engine is one of NORMALIZATION_ENGINES, 'verify' raises an AssertionError if the 'merge' and 'wide' engines disagree.
+# If an IPDAInputCache is given, input files that were read before are loaded from the cache.
+# If an IPDAStageRecorder is given, every stage of the analysis is recorded by it.
+# If a SampleConcentrationStore is given, the DNA concentrations of samples that are not in the
+# DNA_concentrations_used_input_file (which can then also be None) are looked up in it. The store is only read here,
+# so plates analyzed at the same time never see each other's concentrations.
+# Samples without DNA concentrations are reported with a warning before the analysis starts
+# and are listed on the 'Missing DNA concentrations' sheet. If no sample has DNA concentrations, a ValueError is raised
+def IPDA_normalized_to_housekeeping_gene(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets,
+                                         output_directory='output_files', results=None, outlier_sd_multiplier=2,
+                                         target_roles=IPDA_TARGET_ROLES, engine='merge', cache=None, recorder=None,
+                                         concentration_store=None):
+
+    if engine not in NORMALIZATION_ENGINES:
+        raise ValueError('engine must be one of ' + ', '.join(NORMALIZATION_ENGINES) + ', not ' + repr(engine))
+
+    # use the cleaned and quality controlled dataframe and select only data that passed QC tests, then remove the QC test data
+    # all sheets are collected in one IPDAResults object and written once at the end
+    if recorder is None:
+        recorder = NULL_STAGE_RECORDER
+    write_results = results is None
+    if write_results:
+        results = IPDAResults()
+    quality_control = IPDA_quality_control(input_IPDA_file, minimum_required_droplets, output_directory, results, cache, recorder)
+    with recorder.stage('Select passed data') as stage:
+        analyzed_IPDA_data, assay_roles = passed_IPDA_data(quality_control, target_roles)
+        stage.rows = len(analyzed_IPDA_data)
+
+    # these are the DNA concentrations that were used to correct the RPP30 concentration for the HIV concentration
+    with recorder.stage('DNA concentrations') as stage:
+        if DNA_concentrations_used_input_file is not None:
+            if cache is None:
+                DNA_concentration_dataframe = read_DNA_concentrations(DNA_concentrations_used_input_file)
+            else:
+                DNA_concentration_dataframe = cache.read_DNA_concentrations(DNA_concentrations_used_input_file)
+        elif concentration_store is not None:
+            DNA_concentration_dataframe = pd.DataFrame(columns=DNA_CONCENTRATION_COLUMNS).astype(DNA_CONCENTRATION_DTYPES)
+        else:
+            raise ValueError('DNA_concentrations_used_input_file is needed without a concentration_store')
+        DNA_concentration_dataframe = _one_row_per_sample(DNA_concentration_dataframe, 'DNA concentrations')
+
+        # the plate's own file always wins, the store only fills in the samples the file doesn't have
+        missing_samples = samples_without_DNA_concentrations(analyzed_IPDA_data, DNA_concentration_dataframe)
+        if concentration_store is not None and missing_samples:
+            stored_concentrations = concentration_store.DNA_concentrations(missing_samples)
+            if len(DNA_concentration_dataframe) == 0:
+                DNA_concentration_dataframe = stored_concentrations
+            elif len(stored_concentrations) > 0:
+                DNA_concentration_dataframe = pd.concat([DNA_concentration_dataframe, stored_concentrations], ignore_index=True)
+            missing_samples = samples_without_DNA_concentrations(analyzed_IPDA_data, DNA_concentration_dataframe)
+        stage.rows = len(DNA_concentration_dataframe)
+
+    # without any DNA concentrations there is nothing left to analyze
+    if missing_samples and len(missing_samples) == analyzed_IPDA_data['Sample'].nunique():
+        raise ValueError('None of the samples of ' + str(input_IPDA_file) + ' have DNA concentrations: ' + ', '.join(missing_samples))
+    if missing_samples:
+        warnings.warn(str(len(missing_samples)) + ' samples of ' + str(input_IPDA_file) + ' have no DNA concentrations '
+                      'and are left out of the analysis: ' + ', '.join(missing_samples))
+
+    rpp30_combined_df, gag_df, no_HIV_outliers = _normalize(analyzed_IPDA_data, assay_roles, DNA_concentration_dataframe,
+                                                            outlier_sd_multiplier, engine == 'wide', recorder)
+    if engine == 'verify':
+        with recorder.stage('Verify engines') as stage:
+            try:
+                wide_tables = _normalize(analyzed_IPDA_data, assay_roles, DNA_concentration_dataframe, outlier_sd_multiplier, True)
+            except ValueError as error:
+                raise AssertionError('The wide table engine could not analyze the plate that the merge engine analyzed:\n'
+                                     + str(error))
+            _check_normalization_engines_match([rpp30_combined_df, gag_df, no_HIV_outliers], wide_tables)
+            stage.rows = len(wide_tables[1])
+
+    # add the new dataframes to the results, they are saved to the Excel file together with the Quality Control
+    results.add_sheet('RPP30 Analysis', rpp30_combined_df)
+    results.add_sheet('HIV Analysis', gag_df)
+    if missing_samples:
+        results.add_sheet('Missing DNA concentrations', pd.DataFrame({'Sample': missing_samples}))
+    if write_results:
+        with recorder.stage('Write results') as stage:
+            results.write(output_directory)
+            stage.rows = results.row_count()
 
     return no_HIV_outliers.copy()
 
 
 # since we usually only care about the actual results of the analysis,
 # we'll export those results as a separate sheet, ready to be copy-pasted into GraphPad Prism
-# and we also plot the data as .png files here
-def export_analyzed_IPDA_as_Excel_and_png(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets):
+# and we also plot the data as .png files here.
+# outlier_sd_multiplier, target_roles, engine, cache, recorder and concentration_store are passed on to
+# IPDA_normalized_to_housekeeping_gene.
+# output_format can be 'xlsx' (one workbook), 'csv' or 'parquet' (one file per sheet), or None to not save any tables.
+# With render_plots=False no .png files are made and matplotlib is never imported.
+# If an IPDAStageRecorder is given, the times of all stages are also saved as IPDA_stage_report.json in the output_directory.
+# If an IPDAResultsStore is given, the Summary and HIV Analysis tables are also added to it, as the plate_name
+# (the name of the .csv file if it is None) and run_date (today if it is None), replacing earlier results of the plate.
+# If an IPDAResults object is given, all sheets are collected in it, so they can still be used after the analysis
+def export_analyzed_IPDA_as_Excel_and_png(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets,
+                                          output_directory='output_files', output_format='xlsx', outlier_sd_multiplier=2,
+                                          target_roles=IPDA_TARGET_ROLES, engine='merge', cache=None,
+                                          render_plots=True, recorder=None, concentration_store=None,
+                                          results_store=None, plate_name=None, run_date=None, results=None):
+
+    if recorder is None:
+        recorder = NULL_STAGE_RECORDER
 
     # use analyzed dataframe only which is what the IPDA_normalized_to_housekeeping_gene function returns
-    summary_data_to_be_exported = IPDA_normalized_to_housekeeping_gene(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets)
+    if results is None:
+        results = IPDAResults()
+    summary_data_to_be_exported = IPDA_normalized_to_housekeeping_gene(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets,
+                                                                       output_directory, results, outlier_sd_multiplier, target_roles,
+                                                                       engine, cache, recorder, concentration_store)
 
     # select only the 'Sample', "3'Deleted/hypermutated/M (Gag/M)", "5'Deleted/M (Env/M), 'Corrected Intact Concentration/M'
     summary_data_to_be_exported = summary_data_to_be_exported[['Sample', "3'Deleted/hypermutated/M (Gag/M)", "5'Deleted/M (Env/M)", 'Intact/M', 'Intact [%]']]
 
-    # save to Excel sheet two next to Quality Control
-    with pd.ExcelWriter('output_files/Analyzed_IPDA_data.xlsx', engine='openpyxl',
-                        mode='a') as writer:
-        summary_data_to_be_exported.to_excel(writer, sheet_name='Summary', index=False)
-    
-    grouped_df = summary_data_to_be_exported.groupby('Sample', as_index=False).sum()
-    no_percent_intact = grouped_df.drop(['Intact [%]'], axis=1)
-    percent_intact = grouped_df[['Sample', 'Intact [%]']]
+    # save all sheets at once, the Summary sheet goes after Quality Control and the analysis sheets
+    results.add_sheet('Summary', summary_data_to_be_exported)
+    if output_format is not None:
+        with recorder.stage('Write results') as stage:
+            results.write(output_directory, output_format)
+            stage.rows = results.row_count()
+
+    if results_store is not None:
+        if plate_name is None:
+            plate_name = os.path.splitext(os.path.basename(input_IPDA_file))[0]
+        with recorder.stage('Results store') as stage:
+            results_store.add_plate(plate_name, results.sheets, run_date)
+            stage.rows = len(summary_data_to_be_exported)
 
     # create bar plots
-    no_percent_intact.plot.bar(x='Sample', rot=45, title='Copies per million CD4+ T cells')
-    plt.subplots_adjust(left=0.1, right=0.9, bottom=0.4, top=0.9)
-    plt.xlabel('Sample', labelpad=15)
-    plt.savefig('output_files/copies_per_million.png')
-    percent_intact.plot.bar(x='Sample', rot=45, title='% Intact HIV')
-    plt.subplots_adjust(left=0.1, right=0.9, bottom=0.4, top=0.9)
-    plt.xlabel('Sample', labelpad=15)
-    plt.savefig('output_files/percent_intact.png')
-    
+    if render_plots:
+        with recorder.stage('Plots') as stage:
+            render_IPDA_plots(summary_data_to_be_exported, output_directory)
+            stage.rows = len(summary_data_to_be_exported)
+
+    recorder.write_report(output_directory)
+
     return summary_data_to_be_exported
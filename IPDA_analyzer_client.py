@@ -1,8 +1,27 @@
-
 import IPDA_analyzer
+from IPDA_cache import IPDAInputCache
+from IPDA_results_store import IPDAResultsStore
 
 input_IPDA_file = 'input_files/DCC Titan Plate 5.csv'
 input_DNAconcentration = 'input_files/DCC Titan Plate 5_DNAconcentration_input_file.xlsx'
 minimum_required_droplets = 10000
 
-run = IPDA_analyzer.export_analyzed_IPDA_as_Excel_and_png(input_IPDA_file, input_DNAconcentration, minimum_required_droplets)
+# the input files are kept in this folder after they were read once, so re-running with another
+# minimum_required_droplets is faster. This needs the pyarrow package, without it the files are read every time
+cache_directory = 'cache'
+
+# set this to a folder, e.g. 'results_store', to also collect the results of every plate you analyze in that folder
+results_store_directory = None
+
+cache = None
+if cache_directory is not None:
+    try:
+        cache = IPDAInputCache(cache_directory)
+    except ImportError as error:
+        print(str(error) + ', the input files are not cached')
+results_store = None
+if results_store_directory is not None:
+    results_store = IPDAResultsStore(results_store_directory)
+
+run = IPDA_analyzer.export_analyzed_IPDA_as_Excel_and_png(input_IPDA_file, input_DNAconcentration, minimum_required_droplets, cache=cache,
+                                                          results_store=results_store)
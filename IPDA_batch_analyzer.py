@@ -0,0 +1,199 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import IPDA_analyzer
+from IPDA_cache import IPDAInputCache
+from IPDA_concentration_store import SampleConcentrationStore
+from IPDA_instrumentation import IPDAStageRecorder
+from IPDA_plots import PLOT_MODES, render_IPDA_plots
+from IPDA_results import IPDAResults, OUTPUT_FORMATS
+from IPDA_results_store import IPDAResultsStore
+
+
+# the DNA concentration workbook of a plate is found by its name:
+# 'input_files/DCC Titan Plate 5.csv' belongs to 'input_files/DCC Titan Plate 5_DNAconcentration_input_file.xlsx'
+DNA_CONCENTRATION_FILE_SUFFIX = '_DNAconcentration_input_file.xlsx'
+
+
+# This function looks for all .csv files exported from the ddPCR analyzer in an input_directory
+# and pairs each of them with the DNA concentration .xlsx file of the same plate
+def find_IPDA_plates(input_directory):
+
+    plates = []
+    for input_IPDA_file in sorted(glob.glob(os.path.join(input_directory, '*.csv'))):
+        DNA_concentrations_used_input_file = os.path.join(input_directory, IPDA_plate_name(input_IPDA_file) + DNA_CONCENTRATION_FILE_SUFFIX)
+
+        # a plate without DNA concentration file is still added here,
+        # it will show up as a failed plate in the batch report instead of going missing silently
+        plates.append((input_IPDA_file, DNA_concentrations_used_input_file))
+
+    return plates
+
+
+# every plate gets its own folder inside the output_directory, named after the .csv file,
+# so that plates that run at the same time never overwrite each other's Analyzed_IPDA_data.xlsx and .png files
+def IPDA_plate_name(input_IPDA_file):
+    return os.path.splitext(os.path.basename(input_IPDA_file))[0]
+
+
+# this is what each worker process runs for one plate.
+# Returns the Summary of the plate and its samples that have no DNA concentrations
+def _analyze_IPDA_plate(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets, plate_output_directory,
+                        output_format, cache, render_plots, stage_reports, concentration_store, results_store, run_date):
+    os.makedirs(plate_output_directory, exist_ok=True)
+    recorder = None
+    if stage_reports:
+        recorder = IPDAStageRecorder()
+    # with a concentration store, a plate whose samples are all in the store doesn't need its own DNA concentration file
+    if concentration_store is not None and not os.path.exists(DNA_concentrations_used_input_file):
+        DNA_concentrations_used_input_file = None
+    results = IPDAResults()
+    summary = IPDA_analyzer.export_analyzed_IPDA_as_Excel_and_png(input_IPDA_file, DNA_concentrations_used_input_file,
+                                                                  minimum_required_droplets, plate_output_directory, output_format,
+                                                                  cache=cache, render_plots=render_plots, recorder=recorder,
+                                                                  concentration_store=concentration_store,
+                                                                  results_store=results_store,
+                                                                  plate_name=IPDA_plate_name(input_IPDA_file), run_date=run_date,
+                                                                  results=results)
+    missing_samples = []
+    if 'Missing DNA concentrations' in results.sheets:
+        missing_samples = list(results.sheets['Missing DNA concentrations']['Sample'])
+    return summary, missing_samples
+
+
+# This function runs the complete IPDA analysis for many plates at once.
+# plates is either a directory that contains the .csv and DNA concentration .xlsx files
+# or a list of (input_IPDA_file, DNA_concentrations_used_input_file) pairs.
+# The plates are analyzed in parallel worker processes, one plate per worker at a time.
+# A plate that fails does not stop the batch, it is reported in the failures table instead.
+# output_format is passed on to export_analyzed_IPDA_as_Excel_and_png and is also used for the batch summary.
+# If an IPDAInputCache is given, all workers share it.
+# plots is one of PLOT_MODES, with 'background' the plots are drawn by plot_workers separate processes.
+# With stage_reports=True, every plate folder also gets an IPDA_stage_report.json with the time and memory of each stage.
+# If a SampleConcentrationStore is given, the DNA concentrations are taken from it (see IPDA_normalized_to_housekeeping_gene).
+# If an IPDAResultsStore is given, the results of every plate are added to it with the run_date (today if it is None),
+# replacing the results of an earlier analysis of the plate.
+# Returns the combined Summary of all plates, the failures table and the table of samples without DNA concentrations,
+# which were left out of the analysis of their plate
+def export_IPDA_batch(plates, minimum_required_droplets, output_directory='output_files', max_workers=None,
+                      output_format='xlsx', cache=None, plots='inline', plot_workers=1, stage_reports=False,
+                      concentration_store=None, results_store=None, run_date=None):
+
+    if plots not in PLOT_MODES:
+        raise ValueError('plots must be one of ' + ', '.join(PLOT_MODES) + ', not ' + repr(plots))
+
+    if isinstance(plates, str):
+        plates = find_IPDA_plates(plates)
+
+    # two plates with the same name would end up in the same output folder
+    plate_names = [IPDA_plate_name(input_IPDA_file) for input_IPDA_file, _ in plates]
+    duplicated_names = sorted({name for name in plate_names if plate_names.count(name) > 1})
+    if duplicated_names:
+        raise ValueError('Plates must have unique file names, found duplicates: ' + ', '.join(duplicated_names))
+
+    summaries = {}
+    missing_samples = {}
+    failures = []
+    plot_executor = None
+    if plots == 'background':
+        plot_executor = ProcessPoolExecutor(max_workers=plot_workers)
+
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            running_plates = {}
+            for plate_name, (input_IPDA_file, DNA_concentrations_used_input_file) in zip(plate_names, plates):
+                plate_output_directory = os.path.join(output_directory, plate_name)
+                future = executor.submit(_analyze_IPDA_plate, input_IPDA_file, DNA_concentrations_used_input_file,
+                                         minimum_required_droplets, plate_output_directory, output_format, cache,
+                                         plots == 'inline', stage_reports, concentration_store, results_store, run_date)
+                running_plates[future] = (plate_name, input_IPDA_file, plate_output_directory)
+
+            # as soon as a plate is analyzed, its plots are handed to the plot workers
+            running_plots = {}
+            for future in as_completed(running_plates):
+                plate_name, input_IPDA_file, plate_output_directory = running_plates[future]
+                try:
+                    summaries[plate_name], missing_samples[plate_name] = future.result()
+                except Exception as error:
+                    failures.append({'Plate': plate_name, 'File': input_IPDA_file,
+                                     'Error': type(error).__name__ + ': ' + str(error)})
+                    continue
+                if plot_executor is not None:
+                    plot_future = plot_executor.submit(render_IPDA_plots, summaries[plate_name], plate_output_directory)
+                    running_plots[plot_future] = (plate_name, input_IPDA_file)
+
+        # a plate whose plots failed still has its tables, but it is reported as well
+        for plot_future in as_completed(running_plots):
+            plate_name, input_IPDA_file = running_plots[plot_future]
+            try:
+                plot_future.result()
+            except Exception as error:
+                failures.append({'Plate': plate_name, 'File': input_IPDA_file,
+                                 'Error': 'Plots failed: ' + type(error).__name__ + ': ' + str(error)})
+    finally:
+        if plot_executor is not None:
+            plot_executor.shutdown()
+
+    # combine the Summary of all plates that worked into one table, in the same order the plates were given
+    summary_columns = ['Plate', 'Sample', "3'Deleted/hypermutated/M (Gag/M)", "5'Deleted/M (Env/M)", 'Intact/M', 'Intact [%]']
+    finished_plates = [name for name in plate_names if name in summaries]
+    if finished_plates:
+        batch_summary = pd.concat([summaries[name] for name in finished_plates], keys=finished_plates,
+                                  names=['Plate', None]).reset_index(level='Plate').reset_index(drop=True)
+    else:
+        batch_summary = pd.DataFrame(columns=summary_columns)
+    batch_failures = pd.DataFrame(failures, columns=['Plate', 'File', 'Error'])
+    batch_missing_samples = pd.DataFrame([{'Plate': name, 'Sample': sample} for name in finished_plates
+                                          for sample in missing_samples[name]], columns=['Plate', 'Sample'])
+
+    # save the combined results next to the plate folders
+    if output_format is not None:
+        os.makedirs(output_directory, exist_ok=True)
+        batch_results = IPDAResults()
+        batch_results.add_sheet('Summary', batch_summary)
+        batch_results.add_sheet('Failures', batch_failures)
+        batch_results.add_sheet('Missing DNA concentrations', batch_missing_samples)
+        batch_results.write(output_directory, output_format, file_name='Batch_summary')
+
+    return batch_summary, batch_failures, batch_missing_samples
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze every IPDA plate in a folder in parallel.')
+    parser.add_argument('input_directory', help='folder with the ddPCR .csv files and their DNA concentration .xlsx files')
+    parser.add_argument('--output-directory', default='output_files')
+    parser.add_argument('--minimum-required-droplets', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=None, help='number of plates analyzed at the same time')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='xlsx')
+    parser.add_argument('--cache-directory', default=None, help='keep the parsed input files here to re-run faster')
+    parser.add_argument('--plots', choices=PLOT_MODES, default='inline')
+    parser.add_argument('--plot-workers', type=int, default=1, help='number of processes drawing plots with --plots background')
+    parser.add_argument('--stage-reports', action='store_true', help='save the time and memory of each stage for every plate')
+    parser.add_argument('--concentration-store', default=None, help='SQLite file with the DNA concentrations of all samples')
+    parser.add_argument('--results-store', default=None, help='folder that collects the results of all plates')
+    parser.add_argument('--run-date', default=None, help='the run date (YYYY-MM-DD) the plates are stored under, today by default')
+    arguments = parser.parse_args()
+
+    cache = None
+    if arguments.cache_directory is not None:
+        cache = IPDAInputCache(arguments.cache_directory)
+    concentration_store = None
+    if arguments.concentration_store is not None:
+        concentration_store = SampleConcentrationStore(arguments.concentration_store)
+    results_store = None
+    if arguments.results_store is not None:
+        results_store = IPDAResultsStore(arguments.results_store)
+
+    batch_summary, batch_failures, batch_missing_samples = export_IPDA_batch(
+        arguments.input_directory, arguments.minimum_required_droplets, arguments.output_directory, arguments.workers,
+        arguments.output_format, cache, arguments.plots, arguments.plot_workers, arguments.stage_reports,
+        concentration_store, results_store, arguments.run_date)
+    print(str(batch_summary['Plate'].nunique()) + ' plates analyzed, ' + str(len(batch_failures)) + ' failed')
+    for _, failure in batch_failures.iterrows():
+        print(failure['Plate'] + ': ' + failure['Error'])
+    for plate_name, plate_missing_samples in batch_missing_samples.groupby('Plate', sort=False)['Sample']:
+        print(plate_name + ': no DNA concentrations for ' + ', '.join(plate_missing_samples))
@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+import IPDA_analyzer
+from IPDA_instrumentation import IPDAStageRecorder
+from IPDA_results import OUTPUT_FORMATS
+from IPDA_synthetic_plates import PLATE_LAYOUTS, check_synthetic_IPDA_plates, write_synthetic_IPDA_plates
+
+
+# This function analyzes one plate with export_analyzed_IPDA_as_Excel_and_png and an IPDAStageRecorder,
+# so that every stage is measured on its own. Returns the recorded stages
+def benchmark_IPDA_stages(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets, output_directory,
+                          engine='merge', output_format='xlsx', render_plots=False, measure_memory=False):
+
+    recorder = IPDAStageRecorder(measure_memory=measure_memory)
+    IPDA_analyzer.export_analyzed_IPDA_as_Excel_and_png(input_IPDA_file, DNA_concentrations_used_input_file,
+                                                        minimum_required_droplets, output_directory, output_format,
+                                                        engine=engine, render_plots=render_plots, recorder=recorder)
+    return recorder.stages
+
+
+# This function generates synthetic plates of every size in plate_counts (number of plates concatenated into one file),
+# analyzes each of them `repeat` times and keeps the fastest run of every stage.
+# Returns a table with one row per plate count and stage
+def run_IPDA_benchmark(plate_counts=(1, 10, 100, 1000), plate_size=96, replicates=3, engine='merge', output_format='xlsx',
+                       render_plots=False, measure_memory=False, repeat=3, random_seed=0):
+
+    benchmark_rows = []
+    with tempfile.TemporaryDirectory() as benchmark_directory:
+        for n_plates in plate_counts:
+            input_directory = os.path.join(benchmark_directory, str(n_plates) + ' plates')
+            output_directory = os.path.join(input_directory, 'output_files')
+            os.makedirs(output_directory)
+            input_IPDA_file, DNA_concentrations_used_input_file = write_synthetic_IPDA_plates(
+                input_directory, n_plates=n_plates, plate_size=plate_size, replicates=replicates, random_seed=random_seed)
+            check_synthetic_IPDA_plates(input_IPDA_file)
+            with open(input_IPDA_file) as input_file:
+                input_rows = sum(1 for _ in input_file) - 1
+
+            for _ in range(repeat):
+                for stage_record in benchmark_IPDA_stages(input_IPDA_file, DNA_concentrations_used_input_file, 10000,
+                                                          output_directory, engine, output_format, render_plots, measure_memory):
+                    benchmark_rows.append({'Plates': n_plates, 'Input rows': input_rows, **stage_record})
+
+    # the fastest run of each stage, and the most memory any run of the stage needed
+    benchmark = pd.DataFrame(benchmark_rows)
+    aggregations = {'Input rows': 'first', 'Rows': 'first', 'Seconds': 'min'}
+    if measure_memory:
+        aggregations['Peak memory [MB]'] = 'max'
+    return benchmark.groupby(['Plates', 'Stage'], sort=False, as_index=False).agg(aggregations)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each stage of the IPDA analysis on synthetic plates.')
+    parser.add_argument('--plates', type=int, nargs='+', default=[1, 10, 100, 1000],
+                        help='numbers of plates concatenated into one input file')
+    parser.add_argument('--plate-size', type=int, choices=sorted(PLATE_LAYOUTS), default=96)
+    parser.add_argument('--replicates', type=int, default=3)
+    parser.add_argument('--engine', choices=['merge', 'wide'], default='merge')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='xlsx')
+    parser.add_argument('--plots', action='store_true', help='also draw the plots and time them as the Plots stage')
+    parser.add_argument('--memory', action='store_true', help='also measure the peak memory of each stage (slower)')
+    parser.add_argument('--repeat', type=int, default=3, help='the fastest of this many runs is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help='also save the results to this .json file')
+    arguments = parser.parse_args()
+
+    benchmark = run_IPDA_benchmark(arguments.plates, arguments.plate_size, arguments.replicates, arguments.engine,
+                                   arguments.output_format, arguments.plots, arguments.memory, arguments.repeat, arguments.seed)
+    print(benchmark.to_string(index=False))
+    if arguments.json is not None:
+        with open(arguments.json, 'w') as json_file:
+            json.dump(benchmark.to_dict(orient='records'), json_file, indent=2)
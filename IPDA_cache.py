@@ -0,0 +1,110 @@
+import glob
+import hashlib
+import os
+import tempfile
+
+import pandas as pd
+
+import IPDA_analyzer
+
+
+# change this number whenever read_IPDA_plate or read_DNA_concentrations return something different,
+# so that tables stored by an older version of the IPDA Analyzer are not used anymore
+CACHE_VERSION = 1
+
+
+# This function calculates the SHA-256 hash of the content of a file.
+# Two files with the same content have the same hash, no matter what they are called or when they were changed
+def file_sha256(input_file):
+    file_hash = hashlib.sha256()
+    with open(input_file, 'rb') as file_handle:
+        for block in iter(lambda: file_handle.read(1024 * 1024), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+# This class keeps the parsed input files of the IPDA Analyzer on disk (as parquet files),
+# so that re-running the analysis on the same files, e.g. with another minimum_required_droplets,
+# doesn't have to read the .csv and .xlsx files again.
+# The tables are stored under the hash of the input file, so a changed input file is always read again.
+# When the cache_directory gets bigger than max_size_bytes, the tables that were used the longest time ago are deleted
+class IPDAInputCache:
+
+    def __init__(self, cache_directory='cache', max_size_bytes=500 * 1024 * 1024):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('IPDAInputCache needs the pyarrow package, install it with "pip install pyarrow"')
+
+        self.cache_directory = cache_directory
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(cache_directory, exist_ok=True)
+        self._remove_old_tables()
+
+    # same as IPDA_analyzer.read_IPDA_plate, but from the cache if this .csv file was read before
+    def read_IPDA_plate(self, input_IPDA_file):
+        return self._read_cached(input_IPDA_file, 'plate', IPDA_analyzer.read_IPDA_plate)
+
+    # same as IPDA_analyzer.read_DNA_concentrations, but from the cache if this .xlsx file was read before
+    def read_DNA_concentrations(self, DNA_concentrations_used_input_file):
+        return self._read_cached(DNA_concentrations_used_input_file, 'DNA_concentrations', IPDA_analyzer.read_DNA_concentrations)
+
+    def _read_cached(self, input_file, table_name, read_input_file):
+        import pyarrow
+
+        cache_file = os.path.join(self.cache_directory,
+                                  table_name + '_v' + str(CACHE_VERSION) + '_' + file_sha256(input_file) + '.parquet')
+
+        try:
+            # touching the file marks it as recently used, so it is the last one to be deleted
+            os.utime(cache_file)
+            return pd.read_parquet(cache_file)
+        except FileNotFoundError:
+            # the table was never cached, or another plate analyzed at the same time just removed it
+            # to keep the cache small. Either way the input file is read (and cached) again
+            pass
+
+        table = read_input_file(input_file)
+
+        # write to a temporary file first and then rename it, so that plates analyzed at the same time
+        # never see a half written cache file
+        file_handle, temporary_file = tempfile.mkstemp(dir=self.cache_directory, suffix='.tmp')
+        os.close(file_handle)
+        try:
+            table.to_parquet(temporary_file)
+            os.replace(temporary_file, cache_file)
+        except pyarrow.ArrowException:
+            # some tables can't be saved as parquet, e.g. a hand-made workbook with a notes column
+            # that holds both numbers and text. They are used without caching them
+            return table
+        finally:
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+
+        self._remove_old_tables()
+        return table
+
+    # deletes the least recently used tables until the cache is smaller than max_size_bytes
+    def _remove_old_tables(self):
+        cache_files = []
+        for cache_file in glob.glob(os.path.join(self.cache_directory, '*.parquet')):
+            try:
+                file_status = os.stat(cache_file)
+            except FileNotFoundError:
+                continue
+            cache_files.append((file_status.st_mtime, file_status.st_size, cache_file))
+
+        cache_size = sum(size for _, size, _ in cache_files)
+        for _, size, cache_file in sorted(cache_files):
+            if cache_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(cache_file)
+            except FileNotFoundError:
+                pass
+            cache_size -= size
+
+    # deletes all tables of the cache
+    def clear(self):
+        for cache_file in glob.glob(os.path.join(self.cache_directory, '*.parquet')):
+            os.remove(cache_file)
@@ -0,0 +1,97 @@
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+
+import pandas as pd
+
+import IPDA_analyzer
+from IPDA_analyzer import DNA_CONCENTRATION_COLUMNS, DNA_CONCENTRATION_DTYPES
+
+
+# This class keeps the DNA concentrations of all samples ever analyzed in one SQLite database file,
+# so the concentrations of a sample that is run on many plates only have to be entered once.
+# Load the DNA concentration workbooks (or .csv files with the same columns) into it with load_file,
+# and pass it as concentration_store to export_analyzed_IPDA_as_Excel_and_png. The analysis only reads the store,
+# a plate's own DNA concentration file is used for its samples and is not added to the store.
+# Each sample has one row, indexed by its name. Loading a sample again replaces its concentrations.
+# The database is opened for each call, so the store can be handed to the worker processes of the batch analyzer
+class SampleConcentrationStore:
+
+    def __init__(self, database_file='sample_concentrations.sqlite'):
+        self.database_file = database_file
+        database_directory = os.path.dirname(database_file)
+        if database_directory:
+            os.makedirs(database_directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS sample_concentrations ('
+                               'sample TEXT PRIMARY KEY, '
+                               'rpp30_concentration REAL NOT NULL, '
+                               'hiv_concentration REAL NOT NULL, '
+                               'source_file TEXT)')
+
+    # opens the database, commits the changes at the end of the with block and closes it again
+    @contextlib.contextmanager
+    def _connect(self):
+        # plates that are analyzed at the same time may wait a bit for each other's writes
+        connection = sqlite3.connect(self.database_file, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    # This function adds the concentrations of a dataframe with the DNA_CONCENTRATION_COLUMNS to the store.
+    # Rows without a Sample or without concentrations are left out. Returns the number of samples that were stored
+    def load_dataframe(self, DNA_concentration_dataframe, source_file=None):
+
+        missing_columns = [column for column in DNA_CONCENTRATION_COLUMNS if column not in DNA_concentration_dataframe.columns]
+        if missing_columns:
+            raise ValueError('The DNA concentrations need the columns ' + ', '.join(missing_columns))
+
+        DNA_concentrations = DNA_concentration_dataframe[DNA_CONCENTRATION_COLUMNS].dropna()
+        records = [(str(sample), float(rpp30_concentration), float(hiv_concentration), source_file)
+                   for sample, rpp30_concentration, hiv_concentration in DNA_concentrations.itertuples(index=False)]
+
+        with self._connect() as connection:
+            connection.executemany('INSERT INTO sample_concentrations VALUES (?, ?, ?, ?) '
+                                   'ON CONFLICT(sample) DO UPDATE SET rpp30_concentration = excluded.rpp30_concentration, '
+                                   'hiv_concentration = excluded.hiv_concentration, source_file = excluded.source_file',
+                                   records)
+        return len(records)
+
+    # This function loads a DNA concentration workbook (.xlsx, from its Sheet1) or a .csv file with the same columns.
+    # Returns the number of samples that were stored
+    def load_file(self, DNA_concentrations_input_file):
+        if DNA_concentrations_input_file.lower().endswith('.csv'):
+            DNA_concentration_dataframe = pd.read_csv(DNA_concentrations_input_file)
+        else:
+            DNA_concentration_dataframe = IPDA_analyzer.read_DNA_concentrations(DNA_concentrations_input_file)
+        return self.load_dataframe(DNA_concentration_dataframe, os.path.basename(DNA_concentrations_input_file))
+
+    # This function looks up the concentrations of all samples of a plate with one query.
+    # Returns a dataframe with the DNA_CONCENTRATION_COLUMNS, like read_DNA_concentrations, for the samples that were found
+    def DNA_concentrations(self, samples):
+        sample_names = json.dumps([str(sample) for sample in samples])
+        with self._connect() as connection:
+            rows = connection.execute('SELECT sample, rpp30_concentration, hiv_concentration FROM sample_concentrations '
+                                      'WHERE sample IN (SELECT value FROM json_each(?))', (sample_names,)).fetchall()
+        return pd.DataFrame(rows, columns=DNA_CONCENTRATION_COLUMNS).astype(DNA_CONCENTRATION_DTYPES)
+
+    # the number of samples in the store
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute('SELECT COUNT(*) FROM sample_concentrations').fetchone()[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load DNA concentration workbooks into a sample concentration store.')
+    parser.add_argument('database_file', help='the SQLite file of the store, it is created if it does not exist')
+    parser.add_argument('input_files', nargs='+', help='DNA concentration .xlsx files (Sheet1) or .csv files with the same columns')
+    arguments = parser.parse_args()
+
+    store = SampleConcentrationStore(arguments.database_file)
+    for input_file in arguments.input_files:
+        print(input_file + ': ' + str(store.load_file(input_file)) + ' samples')
+    print(str(len(store)) + ' samples in ' + arguments.database_file)
@@ -0,0 +1,110 @@
+import json
+import os
+import time
+import tracemalloc
+
+
+# This class records how long each stage of an IPDA analysis took, how much memory it needed at most
+# and how many rows it produced. Pass it as the recorder of export_analyzed_IPDA_as_Excel_and_png:
+#
+#     recorder = IPDAStageRecorder()
+#     export_analyzed_IPDA_as_Excel_and_png(input_IPDA_file, input_DNAconcentration, 10000, recorder=recorder)
+#     recorder.stages   # one dictionary per stage
+#
+# If a callback is given, it is called with the dictionary of each stage as soon as the stage is finished,
+# e.g. to send the metrics to a scheduler.
+# The peak memory is measured with tracemalloc, which makes the analysis slower. Use measure_memory=False to only measure times
+class IPDAStageRecorder:
+
+    enabled = True
+
+    def __init__(self, callback=None, measure_memory=True):
+        self.callback = callback
+        self.measure_memory = measure_memory
+        self.stages = []
+
+    # use it as `with recorder.stage('Quality Control') as stage:` and set stage.rows inside the with block
+    def stage(self, name):
+        return _RecordedStage(self, name)
+
+    def _add_stage(self, stage_record):
+        self.stages.append(stage_record)
+        if self.callback is not None:
+            self.callback(stage_record)
+
+    # all recorded stages and the total time, as it is saved in the .json report
+    def report(self):
+        return {'Stages': self.stages, 'Total seconds': sum(stage['Seconds'] for stage in self.stages)}
+
+    # saves the report as a .json file in the output_directory, next to the other output files.
+    # Returns the path of the saved file
+    def write_report(self, output_directory, file_name='IPDA_stage_report'):
+        report_path = os.path.join(output_directory, file_name + '.json')
+        with open(report_path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+        return report_path
+
+
+class _RecordedStage:
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.rows = None
+
+    def __enter__(self):
+        # if tracemalloc was already started before, e.g. by the caller to look at the memory of the whole run,
+        # it is not stopped at the end of the stage. Its peak is then set back to the memory that is traced now,
+        # which is subtracted again at the end, so the stage reports only the memory it needed itself either way
+        self.started_tracing = self.recorder.measure_memory and not tracemalloc.is_tracing()
+        self.start_memory = 0
+        if self.started_tracing:
+            tracemalloc.start()
+        elif self.recorder.measure_memory:
+            tracemalloc.reset_peak()
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        stage_record = {'Stage': self.name, 'Seconds': time.perf_counter() - self.start_time, 'Rows': self.rows}
+        if self.recorder.measure_memory:
+            stage_record['Peak memory [MB]'] = (tracemalloc.get_traced_memory()[1] - self.start_memory) / (1024 * 1024)
+            if self.started_tracing:
+                tracemalloc.stop()
+        if exception_type is not None:
+            stage_record['Error'] = repr(exception)
+        self.recorder._add_stage(stage_record)
+        return False
+
+
+# This recorder is used when no recorder is given. It records nothing,
+# so the analysis without instrumentation only pays for entering an empty with block per stage
+class _NullStageRecorder:
+
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def write_report(self, output_directory, file_name='IPDA_stage_report'):
+        return None
+
+
+class _NullStage:
+
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        return False
+
+    # the row counts the analysis sets on the stage are thrown away
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+NULL_STAGE_RECORDER = _NullStageRecorder()
@@ -0,0 +1,41 @@
+import os
+
+
+# how the batch runner draws the plots of each plate:
+# 'inline' draws them in the worker that analyzed the plate, 'skip' doesn't draw them at all
+# and 'background' draws them in separate worker processes while the next plates are analyzed
+PLOT_MODES = ('inline', 'skip', 'background')
+
+
+# This function draws the bar plots of the Summary table and saves them as .png files in the output_directory.
+# matplotlib is only imported here, so analyses that don't need plots never have to load it.
+# The figures are not registered with pyplot and are drawn by the non-interactive Agg canvas,
+# so no window is opened and nothing stays in memory after the plots are saved.
+# Returns the paths of the saved .png files
+def render_IPDA_plots(summary_data, output_directory):
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    grouped_df = summary_data.groupby('Sample', as_index=False, observed=True).sum()
+    no_percent_intact = grouped_df.drop(['Intact [%]'], axis=1)
+    percent_intact = grouped_df[['Sample', 'Intact [%]']]
+
+    # create bar plots
+    plot_paths = []
+    for plot_data, title, file_name in [(no_percent_intact, 'Copies per million CD4+ T cells', 'copies_per_million.png'),
+                                        (percent_intact, '% Intact HIV', 'percent_intact.png')]:
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        try:
+            axes = figure.subplots()
+            plot_data.plot.bar(x='Sample', rot=45, title=title, ax=axes)
+            figure.subplots_adjust(left=0.1, right=0.9, bottom=0.4, top=0.9)
+            axes.set_xlabel('Sample', labelpad=15)
+            plot_path = os.path.join(output_directory, file_name)
+            figure.savefig(plot_path)
+            plot_paths.append(plot_path)
+        finally:
+            figure.clear()
+
+    return plot_paths
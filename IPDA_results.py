@@ -0,0 +1,61 @@
+import os
+
+import pandas as pd
+
+
+# the file formats the results can be saved in.
+# 'xlsx' writes all sheets into one Excel workbook, just like the IPDA Analyzer always did.
+# 'csv' and 'parquet' write one file per sheet, which is much faster for batch runs that nobody opens in Excel.
+# (parquet needs the pyarrow package to be installed)
+OUTPUT_FORMATS = ('xlsx', 'csv', 'parquet')
+
+
+# tempfile.mkdtemp makes folders that only their owner can open. Folders that are renamed into their final place
+# get the permissions a normal os.makedirs would have given them instead, so other users of a shared server can read them
+def use_default_directory_permissions(directory):
+    # the umask can only be read by setting it, so it is set back right away
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(directory, 0o777 & ~umask)
+
+
+# This class collects all tables (sheets) of an IPDA analysis in memory
+# so that the output file is written once at the end of the analysis
+# instead of being reopened every time a new sheet is added
+class IPDAResults:
+
+    def __init__(self):
+        # sheet name -> DataFrame, in the order the sheets will be saved
+        self.sheets = {}
+
+    def add_sheet(self, sheet_name, dataframe):
+        self.sheets[sheet_name] = dataframe
+
+    # the number of rows of all collected sheets together
+    def row_count(self):
+        return sum(len(dataframe) for dataframe in self.sheets.values())
+
+    # this function saves all collected sheets to the output_directory and returns the paths it wrote.
+    # file_name is used as the name of the workbook ('Analyzed_IPDA_data.xlsx')
+    # or as the beginning of the name of each sheet file ('Analyzed_IPDA_data_Quality_Control.csv')
+    def write(self, output_directory, output_format='xlsx', file_name='Analyzed_IPDA_data'):
+
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('output_format must be one of ' + ', '.join(OUTPUT_FORMATS) + ', not ' + repr(output_format))
+
+        if output_format == 'xlsx':
+            output_path = os.path.join(output_directory, file_name + '.xlsx')
+            with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
+                for sheet_name, dataframe in self.sheets.items():
+                    dataframe.to_excel(writer, sheet_name=sheet_name, index=False)
+            return [output_path]
+
+        output_paths = []
+        for sheet_name, dataframe in self.sheets.items():
+            output_path = os.path.join(output_directory, file_name + '_' + sheet_name.replace(' ', '_') + '.' + output_format)
+            if output_format == 'csv':
+                dataframe.to_csv(output_path, index=False)
+            else:
+                dataframe.to_parquet(output_path, index=False)
+            output_paths.append(output_path)
+        return output_paths
@@ -0,0 +1,183 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import urllib.parse
+
+import pandas as pd
+
+from IPDA_results import use_default_directory_permissions
+
+
+# the tables of export_analyzed_IPDA_as_Excel_and_png that are kept in the results store, and their file names
+STORED_SHEETS = {'Summary': 'summary.parquet', 'HIV Analysis': 'hiv_analysis.parquet'}
+
+# the results query_samples returns for each replicate of a sample
+SAMPLE_RESULT_COLUMNS = ["3'Deleted/hypermutated/M (Gag/M)", "5'Deleted/M (Env/M)", 'Intact/M', 'Intact [%]']
+
+
+# This class keeps the Summary and HIV Analysis tables of every analyzed plate in one folder, as parquet files
+# in one partition per plate: '<store_directory>/run_date=2024-05-01/plate=DCC Titan Plate 5/'.
+# A small SQLite index remembers which partitions contain which samples, so the results of a sample
+# on all plates are found by reading only the partitions it is in, not the workbooks of every plate.
+# Pass it as results_store to export_analyzed_IPDA_as_Excel_and_png and read the results with query_samples.
+# A plate is known by its name, adding a plate again (e.g. after it was re-analyzed on another day)
+# replaces its results and run date, so the store never has the same plate twice
+class IPDAResultsStore:
+
+    def __init__(self, store_directory='results_store'):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('IPDAResultsStore needs the pyarrow package, install it with "pip install pyarrow"')
+
+        self.store_directory = store_directory
+        os.makedirs(store_directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS plates ('
+                               'plate TEXT NOT NULL, run_date TEXT NOT NULL, partition_directory TEXT NOT NULL, '
+                               'PRIMARY KEY (plate, run_date))')
+            connection.execute('CREATE TABLE IF NOT EXISTS samples ('
+                               'sample TEXT NOT NULL, plate TEXT NOT NULL, run_date TEXT NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS samples_by_sample ON samples (sample)')
+            connection.execute('CREATE INDEX IF NOT EXISTS samples_by_plate ON samples (plate, run_date)')
+
+    # opens the index, commits the changes at the end of the with block and closes it again
+    @contextlib.contextmanager
+    def _connect(self):
+        # plates that are analyzed at the same time may wait a bit for each other's writes
+        connection = sqlite3.connect(os.path.join(self.store_directory, 'index.sqlite'), timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    # the folder of a plate and run date inside the store, the plate name is escaped so that any file name works
+    @staticmethod
+    def _partition_directory(plate_name, run_date):
+        return os.path.join('run_date=' + run_date, 'plate=' + urllib.parse.quote(plate_name, safe=' '))
+
+    # This function adds the tables of one analyzed plate to the store.
+    # sheets maps sheet names to dataframes, like IPDAResults.sheets; only the STORED_SHEETS are kept.
+    # run_date is a datetime.date or 'YYYY-MM-DD' text, today if it is None.
+    # The earlier results of a plate with the same name are removed, whatever their run date.
+    # Returns the folder the tables were saved in
+    def add_plate(self, plate_name, sheets, run_date=None):
+
+        if run_date is None:
+            run_date = datetime.date.today()
+        run_date = pd.Timestamp(run_date).date().isoformat()
+        if 'Summary' not in sheets:
+            raise ValueError('The results of a plate need a Summary table')
+
+        # the tables are written to a temporary folder that replaces the partition when it is complete,
+        # so a query never reads a half written plate
+        partition_directory = self._partition_directory(plate_name, run_date)
+        final_directory = os.path.join(self.store_directory, partition_directory)
+        os.makedirs(os.path.dirname(final_directory), exist_ok=True)
+        temporary_directory = tempfile.mkdtemp(dir=os.path.dirname(final_directory), prefix='.tmp')
+        use_default_directory_permissions(temporary_directory)
+        try:
+            for sheet_name, file_name in STORED_SHEETS.items():
+                if sheet_name in sheets:
+                    _storable(sheets[sheet_name]).to_parquet(os.path.join(temporary_directory, file_name), index=False)
+
+            old_directory = None
+            if os.path.exists(final_directory):
+                old_directory = tempfile.mkdtemp(dir=os.path.dirname(final_directory), prefix='.old')
+                os.replace(final_directory, os.path.join(old_directory, 'plate'))
+            os.replace(temporary_directory, final_directory)
+            if old_directory is not None:
+                shutil.rmtree(old_directory, ignore_errors=True)
+        finally:
+            if os.path.exists(temporary_directory):
+                shutil.rmtree(temporary_directory, ignore_errors=True)
+
+        samples = sheets['Summary']['Sample'].astype(str).unique()
+        with self._connect() as connection:
+            earlier_partitions = connection.execute('SELECT partition_directory FROM plates WHERE plate = ? AND run_date != ?',
+                                                    (plate_name, run_date)).fetchall()
+            connection.execute('DELETE FROM samples WHERE plate = ?', (plate_name,))
+            connection.execute('DELETE FROM plates WHERE plate = ?', (plate_name,))
+            connection.execute('INSERT INTO plates VALUES (?, ?, ?)', (plate_name, run_date, partition_directory))
+            connection.executemany('INSERT INTO samples VALUES (?, ?, ?)',
+                                   [(sample, plate_name, run_date) for sample in samples])
+
+        # the partitions of earlier run dates are only removed when the index doesn't point to them anymore
+        for earlier_partition, in earlier_partitions:
+            shutil.rmtree(os.path.join(self.store_directory, earlier_partition), ignore_errors=True)
+
+        return final_directory
+
+    # all plates in the store with their run dates, sorted by run date
+    def plates(self):
+        with self._connect() as connection:
+            rows = connection.execute('SELECT plate, run_date FROM plates ORDER BY run_date, plate').fetchall()
+        return pd.DataFrame(rows, columns=['Plate', 'Run date'])
+
+    # This function finds the results of the given samples on all plates in the store.
+    # sheet_name is 'Summary' (the default) or 'HIV Analysis'.
+    # Returns one row per replicate with the Sample, Plate, Run date and the SAMPLE_RESULT_COLUMNS
+    # (or all columns of the HIV Analysis table), sorted by Sample and Run date
+    def query_samples(self, samples, sheet_name='Summary'):
+
+        if sheet_name not in STORED_SHEETS:
+            raise ValueError('sheet_name must be one of ' + ', '.join(STORED_SHEETS) + ', not ' + repr(sheet_name))
+        samples = [str(sample) for sample in samples]
+
+        with self._connect() as connection:
+            partitions = connection.execute('SELECT DISTINCT plates.partition_directory '
+                                            'FROM samples JOIN plates USING (plate, run_date) '
+                                            'WHERE samples.sample IN (SELECT value FROM json_each(?))',
+                                            (json.dumps(samples),)).fetchall()
+        table_files = [os.path.join(self.store_directory, partition_directory, STORED_SHEETS[sheet_name])
+                       for partition_directory, in partitions]
+        table_files = [table_file for table_file in table_files if os.path.exists(table_file)]
+
+        result_columns = ['Sample', 'Plate', 'Run date'] + SAMPLE_RESULT_COLUMNS
+        if not table_files:
+            return pd.DataFrame(columns=result_columns)
+
+        # all partitions of the samples are read in one go, the plate and run date come from their folder names
+        # (as text, so that a plate called '007' isn't read as the number 7)
+        import pyarrow
+        import pyarrow.dataset
+        partitioning = pyarrow.dataset.partitioning(pyarrow.schema([('run_date', pyarrow.string()), ('plate', pyarrow.string())]),
+                                                    flavor='hive')
+        dataset = pyarrow.dataset.dataset(table_files, format='parquet', partitioning=partitioning,
+                                          partition_base_dir=self.store_directory)
+        sample_results = dataset.to_table(filter=pyarrow.dataset.field('Sample').isin(samples)).to_pandas()
+        sample_results = sample_results.rename(columns={'plate': 'Plate', 'run_date': 'Run date'})
+        sample_results['Run date'] = pd.to_datetime(sample_results['Run date'])
+
+        if sheet_name != 'Summary':
+            result_columns = result_columns[:3] + [column for column in sample_results.columns if column not in result_columns[:3]]
+        sample_results = sample_results[result_columns]
+        return sample_results.sort_values(['Sample', 'Run date', 'Plate'], kind='stable').reset_index(drop=True)
+
+
+# the categorical Well, Sample and Target columns are saved as text,
+# so that the tables of all plates have the same columns, no matter which samples are on them
+def _storable(dataframe):
+    categorical_columns = dataframe.select_dtypes('category').columns
+    return dataframe.astype({column: str for column in categorical_columns})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the results of samples on all plates in an IPDA results store.')
+    parser.add_argument('store_directory')
+    parser.add_argument('samples', nargs='*', help='the samples to show, all plates in the store are listed without samples')
+    parser.add_argument('--hiv-analysis', action='store_true', help='show the HIV Analysis rows instead of the Summary')
+    arguments = parser.parse_args()
+
+    store = IPDAResultsStore(arguments.store_directory)
+    if arguments.samples:
+        sheet_name = 'HIV Analysis' if arguments.hiv_analysis else 'Summary'
+        print(store.query_samples(arguments.samples, sheet_name).to_string(index=False))
+    else:
+        print(store.plates().to_string(index=False))
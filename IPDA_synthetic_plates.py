@@ -0,0 +1,217 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import IPDA_analyzer
+
+
+# the header of the .csv file exported from the ddPCR analyzer.
+# IPDA_quality_control reads the Well, Sample, Target, Concentration, droplet and AcceptedDroplets columns by position
+DDPCR_CSV_HEADER = ['Well', 'ExptType', 'Experiment', 'Sample', 'TargetType', 'Target', 'Status', 'Concentration',
+                    'Supermix', 'CopiesPer20uLWell', 'TotalConfMax', 'TotalConfMin', 'PoissonConfMax', 'PoissonConfMin',
+                    'Positives', 'Negatives', 'Ch1+Ch2+', 'Ch1+Ch2-', 'Ch1-Ch2+', 'Ch1-Ch2-', 'Linkage', 'AcceptedDroplets']
+
+# the volume of one droplet in µL, used to turn the fraction of positive droplets into copies/µL
+DROPLET_VOLUME = 0.00085
+
+# the two Targets (Ch1 = FAM, Ch2 = VIC) that are measured in the RPP30 wells and in the HIV wells
+RPP30_TARGETS = ('Rpp30 Shear', 'RPP30 vic')
+HIV_TARGETS = ('Psi', 'Env')
+
+# rows and columns of the plates the ddPCR analyzer can read
+PLATE_LAYOUTS = {96: ('ABCDEFGH', 12), 384: ('ABCDEFGHIJKLMNOP', 24)}
+
+# the merged rows are numbered with three digits (M001, M002, ...),
+# so that they never have the name of a real well, not even of row M of a 384 well plate
+MERGED_WELL_PATTERN = r'M\d{3}'
+
+
+# the Well names of a plate in the order the analyzer exports them: A01, A02, ..., B01, ...
+def plate_wells(plate_size):
+    rows, columns = PLATE_LAYOUTS[plate_size]
+    return [row + str(column).zfill(2) for row in rows for column in range(1, columns + 1)]
+
+
+# This function draws the droplet counts of many wells at once.
+# Each well has copies_per_droplet linked copies (positive in both channels, e.g. unsheared RPP30 or intact HIV)
+# and copies_per_droplet_channel1/2 copies that are only positive in one channel.
+# Returns the number of Ch1+Ch2+, Ch1+Ch2-, Ch1-Ch2+ and Ch1-Ch2- droplets of each well
+def _droplet_counts(random_generator, accepted_droplets, copies_per_droplet, copies_per_droplet_channel1, copies_per_droplet_channel2):
+
+    linked = 1 - np.exp(-copies_per_droplet)
+    channel1 = 1 - np.exp(-copies_per_droplet_channel1)
+    channel2 = 1 - np.exp(-copies_per_droplet_channel2)
+    probabilities = np.column_stack([
+        linked + (1 - linked) * channel1 * channel2,
+        (1 - linked) * channel1 * (1 - channel2),
+        (1 - linked) * (1 - channel1) * channel2,
+        (1 - linked) * (1 - channel1) * (1 - channel2)])
+    return random_generator.multinomial(accepted_droplets, probabilities)
+
+
+# the concentration in copies/µL the analyzer reports for a channel, as text like in the exported .csv file.
+# wells without a single positive droplet are reported as 'No Call' if no_call is True
+def _concentrations(positive_droplets, accepted_droplets, no_call):
+    concentration = -np.log1p(-positive_droplets / accepted_droplets) / DROPLET_VOLUME
+    concentration = np.char.mod('%.3f', concentration)
+    return np.where(no_call & (positive_droplets == 0), 'No Call', concentration)
+
+
+# This function creates the ddPCR analyzer export of n_plates plates and the DNA concentrations of their samples.
+# Every sample has `replicates` RPP30 wells and `replicates` HIV wells, so a 96 well plate with 3 replicates has 16 samples.
+# - failing_well_fraction of the wells have less than 10,000 droplets and fail the quality control
+# - no_call_fraction of the samples have no HIV at all and their empty HIV wells are reported as 'No Call'
+# - with merged_wells=True, each Target of each sample also gets a merged 'M001' row, like an export of "Both"
+# The samples of plate number 3 are called 'P0003_S01', 'P0003_S02', ..., so that many plates can be concatenated.
+# Returns the analyzer export and the DNA concentration table as dataframes
+def synthetic_IPDA_plates(n_plates=1, plate_size=96, replicates=3, failing_well_fraction=0.05, no_call_fraction=0.1,
+                          merged_wells=False, random_seed=None):
+
+    if plate_size not in PLATE_LAYOUTS:
+        raise ValueError('plate_size must be one of ' + ', '.join(str(size) for size in PLATE_LAYOUTS))
+    samples_per_plate = plate_size // (2 * replicates)
+    if samples_per_plate == 0:
+        raise ValueError('a plate with ' + str(plate_size) + ' wells cannot hold ' + str(replicates) + ' replicates')
+
+    random_generator = np.random.default_rng(random_seed)
+    n_samples = n_plates * samples_per_plate
+    wells = np.array(plate_wells(plate_size))
+
+    # sample properties: how much DNA, how sheared, how much HIV and how much of it is intact
+    plate_numbers = np.repeat(np.arange(1, n_plates + 1), samples_per_plate)
+    sample_numbers = np.tile(np.arange(1, samples_per_plate + 1), n_plates)
+    sample_names = np.char.add(np.char.add(np.char.add('P', np.char.zfill(plate_numbers.astype(str), 4)), '_S'),
+                               np.char.zfill(sample_numbers.astype(str), 2))
+    RPP30_copies = random_generator.uniform(0.05, 0.3, n_samples)
+    unsheared_fraction = random_generator.uniform(0.5, 0.85, n_samples)
+    HIV_copies = random_generator.uniform(2e-4, 3e-3, n_samples)
+    HIV_copies[random_generator.random(n_samples) < no_call_fraction] = 0
+    intact_fraction = random_generator.uniform(0.05, 0.4, n_samples)
+
+    # each sample fills 2 * replicates wells of its plate: first the RPP30 wells, then the HIV wells
+    well_samples = np.repeat(np.arange(n_samples), 2 * replicates)
+    well_is_RPP30 = np.tile(np.repeat([True, False], replicates), n_samples)
+    well_names = np.tile(wells[:samples_per_plate * 2 * replicates], n_plates)
+    n_wells = len(well_samples)
+
+    accepted_droplets = random_generator.integers(12000, 20000, n_wells)
+    failing_wells = random_generator.random(n_wells) < failing_well_fraction
+    accepted_droplets[failing_wells] = random_generator.integers(3000, 10000, failing_wells.sum())
+
+    # replicates of the same sample differ by a few percent, like pipetting errors
+    pipetting = random_generator.normal(1, 0.05, n_wells).clip(0.5)
+    copies = np.where(well_is_RPP30, RPP30_copies[well_samples], HIV_copies[well_samples]) * pipetting
+    linked_fraction = np.where(well_is_RPP30, unsheared_fraction[well_samples], intact_fraction[well_samples])
+    single_channel_copies = copies * (1 - linked_fraction)
+    droplets = _droplet_counts(random_generator, accepted_droplets, copies * linked_fraction,
+                               single_channel_copies, single_channel_copies)
+
+    channel1_positives = droplets[:, 0] + droplets[:, 1]
+    channel2_positives = droplets[:, 0] + droplets[:, 2]
+    no_call = ~well_is_RPP30
+    channel1_targets = np.where(well_is_RPP30, RPP30_TARGETS[0], HIV_TARGETS[0])
+    channel2_targets = np.where(well_is_RPP30, RPP30_TARGETS[1], HIV_TARGETS[1])
+
+    # every well is exported as two rows, one for each channel
+    export = pd.DataFrame({
+        'Well': np.concatenate([well_names, well_names]),
+        'Sample': np.concatenate([sample_names[well_samples], sample_names[well_samples]]),
+        'Target': np.concatenate([channel1_targets, channel2_targets]),
+        'Concentration': np.concatenate([_concentrations(channel1_positives, accepted_droplets, no_call),
+                                         _concentrations(channel2_positives, accepted_droplets, no_call)]),
+        'Ch1+Ch2+': np.tile(droplets[:, 0], 2),
+        'Ch1+Ch2-': np.tile(droplets[:, 1], 2),
+        'Ch1-Ch2+': np.tile(droplets[:, 2], 2),
+        'Ch1-Ch2-': np.tile(droplets[:, 3], 2),
+        'AcceptedDroplets': np.tile(accepted_droplets, 2),
+        'Positives': np.concatenate([channel1_positives, channel2_positives])})
+    export['Negatives'] = export['AcceptedDroplets'] - export['Positives']
+    export['Order'] = np.concatenate([np.arange(n_wells) * 2, np.arange(n_wells) * 2 + 1])
+
+    if merged_wells:
+        export = pd.concat([export, _merged_rows(export, samples_per_plate)], ignore_index=True)
+
+    # the analyzer exports all rows of a well together, followed by the merged rows
+    export = export.sort_values('Order', kind='stable').drop(columns='Order').reset_index(drop=True)
+    export = export.reindex(columns=DDPCR_CSV_HEADER, fill_value='')
+    export['ExptType'] = 'Absolute Quantification'
+    export['Status'] = 'Manual'
+    export['Supermix'] = 'ddPCR Supermix for Probes (No dUTP)'
+
+    DNA_concentration_dataframe = pd.DataFrame({
+        'Sample': sample_names,
+        'DNA conc I used [ng/µL] for RPP30': random_generator.uniform(1, 5, n_samples).round(2),
+        'DNA conc I used [ng/µL] for HIV Gag Env reactions': random_generator.uniform(50, 200, n_samples).round(1)})
+
+    return export, DNA_concentration_dataframe
+
+
+# the merged 'M001' rows of an export of "Both": one row per Sample and Target with the droplets of all its wells added up
+def _merged_rows(export, samples_per_plate):
+    merged = export.groupby(['Sample', 'Target'], sort=False, as_index=False).agg({
+        'Ch1+Ch2+': 'sum', 'Ch1+Ch2-': 'sum', 'Ch1-Ch2+': 'sum', 'Ch1-Ch2-': 'sum', 'AcceptedDroplets': 'sum',
+        'Positives': 'sum', 'Negatives': 'sum', 'Order': 'max'})
+    merged_concentration = -np.log1p(-merged['Positives'] / merged['AcceptedDroplets']) / DROPLET_VOLUME
+    merged['Concentration'] = np.char.mod('%.3f', merged_concentration.to_numpy())
+    merged_number = merged.groupby('Target', sort=False).cumcount() % samples_per_plate + 1
+    merged['Well'] = 'M' + merged_number.astype(str).str.zfill(3)
+    merged['Order'] = merged['Order'] + 2 * len(export)
+    return merged
+
+
+# This function writes the ddPCR analyzer export and the DNA concentration workbook of synthetic plates
+# like the files users put into input_files: '<plate_name>.csv' and '<plate_name>_DNAconcentration_input_file.xlsx'.
+# All keyword arguments are passed on to synthetic_IPDA_plates.
+# Returns the paths of the .csv and the .xlsx file
+def write_synthetic_IPDA_plates(output_directory, plate_name='Synthetic plate', **plate_options):
+
+    export, DNA_concentration_dataframe = synthetic_IPDA_plates(**plate_options)
+
+    os.makedirs(output_directory, exist_ok=True)
+    input_IPDA_file = os.path.join(output_directory, plate_name + '.csv')
+    DNA_concentrations_used_input_file = os.path.join(output_directory, plate_name + '_DNAconcentration_input_file.xlsx')
+    export.to_csv(input_IPDA_file, index=False)
+    DNA_concentration_dataframe.to_excel(DNA_concentrations_used_input_file, sheet_name='Sheet1', index=False)
+
+    return input_IPDA_file, DNA_concentrations_used_input_file
+
+
+# This function checks that IPDA_analyzer.read_IPDA_plate keeps every single well row of a synthetic .csv file
+# and drops only its merged rows, so that the benchmark measures whole plates.
+# Raises an AssertionError that names the wells that were lost or kept by mistake
+def check_synthetic_IPDA_plates(input_IPDA_file):
+
+    export = pd.read_csv(input_IPDA_file, usecols=['Well'], dtype=str, keep_default_na=False)
+    single_wells = export.loc[~export['Well'].str.fullmatch(MERGED_WELL_PATTERN), 'Well']
+    read_wells = IPDA_analyzer.read_IPDA_plate(input_IPDA_file)['Well']
+
+    missing_rows = single_wells.value_counts().subtract(read_wells.value_counts(), fill_value=0)
+    wrong_wells = sorted(missing_rows.index[missing_rows != 0])
+    if wrong_wells:
+        raise AssertionError('read_IPDA_plate did not return the single well rows of ' + str(input_IPDA_file)
+                             + ' for the wells ' + ', '.join(wrong_wells))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic ddPCR analyzer exports for testing the IPDA Analyzer.')
+    parser.add_argument('output_directory')
+    parser.add_argument('--plate-name', default='Synthetic plate')
+    parser.add_argument('--plates', type=int, default=1, help='number of plates concatenated into one file')
+    parser.add_argument('--plate-size', type=int, choices=sorted(PLATE_LAYOUTS), default=96)
+    parser.add_argument('--replicates', type=int, default=3)
+    parser.add_argument('--failing-well-fraction', type=float, default=0.05)
+    parser.add_argument('--no-call-fraction', type=float, default=0.1)
+    parser.add_argument('--merged-wells', action='store_true', help='also export merged M rows, like "Both"')
+    parser.add_argument('--seed', type=int, default=None)
+    arguments = parser.parse_args()
+
+    written_files = write_synthetic_IPDA_plates(arguments.output_directory, arguments.plate_name, n_plates=arguments.plates,
+                                                plate_size=arguments.plate_size, replicates=arguments.replicates,
+                                                failing_well_fraction=arguments.failing_well_fraction,
+                                                no_call_fraction=arguments.no_call_fraction,
+                                                merged_wells=arguments.merged_wells, random_seed=arguments.seed)
+    check_synthetic_IPDA_plates(written_files[0])
+    for written_file in written_files:
+        print(written_file)
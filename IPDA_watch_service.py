@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from IPDA_batch_analyzer import IPDA_plate_name, _analyze_IPDA_plate, find_IPDA_plates
+from IPDA_cache import IPDAInputCache, file_sha256
+from IPDA_concentration_store import SampleConcentrationStore
+from IPDA_results import OUTPUT_FORMATS, use_default_directory_permissions
+from IPDA_results_store import IPDAResultsStore
+
+
+# every finished plate folder contains this file with the hashes of the input files it was made from
+# and the settings it was analyzed with.
+# If the folder and the file are still there after a restart with the same settings, the plate is not analyzed again
+PROCESSED_INPUTS_FILE = 'IPDA_input_files.json'
+
+
+# the hashes of the .csv and the DNA concentration .xlsx file of a plate, and the settings that change its output files.
+# A plate whose samples are all in the concentration store may have no .xlsx file, its hash is then None
+def _processed_inputs(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets, output_format,
+                      render_plots):
+    DNA_concentrations_hash = None
+    if os.path.exists(DNA_concentrations_used_input_file):
+        DNA_concentrations_hash = file_sha256(DNA_concentrations_used_input_file)
+    return {'csv': file_sha256(input_IPDA_file), 'xlsx': DNA_concentrations_hash,
+            'minimum_required_droplets': minimum_required_droplets, 'output_format': output_format,
+            'render_plots': render_plots}
+
+
+# This function returns True if the folder of a plate in the output_directory was made from exactly these input files
+# with the same minimum_required_droplets, output_format and render_plots
+def is_IPDA_plate_processed(input_IPDA_file, DNA_concentrations_used_input_file, output_directory, minimum_required_droplets,
+                            output_format='xlsx', render_plots=True):
+
+    processed_inputs_file = os.path.join(output_directory, IPDA_plate_name(input_IPDA_file), PROCESSED_INPUTS_FILE)
+    try:
+        with open(processed_inputs_file) as processed_inputs_handle:
+            processed_inputs = json.load(processed_inputs_handle)
+    except (FileNotFoundError, ValueError):
+        return False
+    return processed_inputs == _processed_inputs(input_IPDA_file, DNA_concentrations_used_input_file,
+                                                 minimum_required_droplets, output_format, render_plots)
+
+
+# This is what each worker process runs for one plate. The plate is analyzed into a temporary folder
+# inside the output_directory, which is renamed to the plate folder when everything is saved,
+# so the plate folder never contains the output files of an analysis that is still running or crashed.
+# Returns the plate folder and the samples of the plate that have no DNA concentrations
+def _analyze_IPDA_plate_atomically(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets,
+                                   output_directory, output_format, cache, render_plots, stage_reports,
+                                   concentration_store, results_store):
+
+    plate_name = IPDA_plate_name(input_IPDA_file)
+    plate_output_directory = os.path.join(output_directory, plate_name)
+    processed_inputs = _processed_inputs(input_IPDA_file, DNA_concentrations_used_input_file, minimum_required_droplets,
+                                         output_format, render_plots)
+
+    os.makedirs(output_directory, exist_ok=True)
+    temporary_directory = tempfile.mkdtemp(dir=output_directory, prefix='.' + plate_name + '.', suffix='.tmp')
+    use_default_directory_permissions(temporary_directory)
+    try:
+        _, missing_samples = _analyze_IPDA_plate(input_IPDA_file, DNA_concentrations_used_input_file,
+                                                 minimum_required_droplets, temporary_directory, output_format, cache,
+                                                 render_plots, stage_reports, concentration_store, results_store, None)
+        with open(os.path.join(temporary_directory, PROCESSED_INPUTS_FILE), 'w') as processed_inputs_handle:
+            json.dump(processed_inputs, processed_inputs_handle, indent=2)
+
+        # a folder can't be replaced by another one in one step, so an old result is moved away first
+        old_directory = None
+        if os.path.exists(plate_output_directory):
+            old_directory = tempfile.mkdtemp(dir=output_directory, prefix='.' + plate_name + '.', suffix='.old')
+            use_default_directory_permissions(old_directory)
+            os.replace(plate_output_directory, os.path.join(old_directory, plate_name))
+        os.replace(temporary_directory, plate_output_directory)
+        if old_directory is not None:
+            shutil.rmtree(old_directory, ignore_errors=True)
+    finally:
+        if os.path.exists(temporary_directory):
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    return plate_output_directory, missing_samples
+
+
+# This class watches an input_directory for plates exported from the ddPCR analyzer and analyzes each of them
+# as soon as its .csv file and its DNA concentration .xlsx file (see DNA_CONCENTRATION_FILE_SUFFIX) are both there,
+# or as soon as its .csv file is there if a concentration_store is given (the .xlsx file is then optional).
+# A plate is ready when its files haven't changed between two looks at the folder, so files that are still
+# being copied are not analyzed half written. Ready plates go into an asyncio queue that max_workers
+# worker processes take them from. Plates that were already analyzed from the same files with the same settings
+# are skipped, also after a restart; a plate whose files change is analyzed again.
+# Unfinished plate folders that a crashed run left in the output_directory are removed when the service starts.
+# cache, stage_reports, concentration_store and results_store work like in export_IPDA_batch,
+# plates are added to the results store with the date they were analyzed.
+# Call run() to watch the folder until stopped, or process_ready_plates() to analyze what is there now and return
+class IPDAWatchService:
+
+    def __init__(self, input_directory, output_directory='output_files', minimum_required_droplets=10000, max_workers=2,
+                 poll_interval=10, output_format='xlsx', cache=None, render_plots=True, stage_reports=False,
+                 concentration_store=None, results_store=None):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('output_format must be one of ' + ', '.join(OUTPUT_FORMATS) + ', not ' + repr(output_format))
+
+        self.input_directory = input_directory
+        self.output_directory = output_directory
+        self.minimum_required_droplets = minimum_required_droplets
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.output_format = output_format
+        self.cache = cache
+        self.render_plots = render_plots
+        self.stage_reports = stage_reports
+        self.concentration_store = concentration_store
+        self.results_store = results_store
+
+        # plate name -> sizes and modification times of its files when it was last seen, processed or failed
+        self._last_seen = {}
+        self._processed = {}
+        self._failed = {}
+        self._queued = set()
+
+    # the sizes and modification times of the files of a plate, they change while a file is written.
+    # Raises FileNotFoundError if the .xlsx file is missing and there is no concentration_store to use instead
+    def _file_signature(self, input_IPDA_file, DNA_concentrations_used_input_file):
+        csv_status = os.stat(input_IPDA_file)
+        try:
+            xlsx_status = os.stat(DNA_concentrations_used_input_file)
+        except FileNotFoundError:
+            if self.concentration_store is None:
+                raise
+            return (csv_status.st_size, csv_status.st_mtime_ns, None, None)
+        return (csv_status.st_size, csv_status.st_mtime_ns, xlsx_status.st_size, xlsx_status.st_mtime_ns)
+
+    # This function looks at the input_directory once and returns the plates that are ready to be analyzed.
+    # With wait_until_unchanged=False, plates are ready the first time they are seen
+    def ready_plates(self, wait_until_unchanged=True):
+
+        ready_plates = []
+        for input_IPDA_file, DNA_concentrations_used_input_file in find_IPDA_plates(self.input_directory):
+            plate_name = IPDA_plate_name(input_IPDA_file)
+            if plate_name in self._queued:
+                continue
+            try:
+                signature = self._file_signature(input_IPDA_file, DNA_concentrations_used_input_file)
+            except FileNotFoundError:
+                # the DNA concentration file isn't there yet (or the .csv file was just removed)
+                continue
+
+            last_seen, self._last_seen[plate_name] = self._last_seen.get(plate_name), signature
+            if signature in (self._processed.get(plate_name), self._failed.get(plate_name)):
+                continue
+            if wait_until_unchanged and signature != last_seen:
+                continue
+
+            # after a restart, the files are hashed once to find out if their results are already there
+            if plate_name not in self._processed and is_IPDA_plate_processed(
+                    input_IPDA_file, DNA_concentrations_used_input_file, self.output_directory,
+                    self.minimum_required_droplets, self.output_format, self.render_plots):
+                self._processed[plate_name] = signature
+                continue
+
+            ready_plates.append((plate_name, input_IPDA_file, DNA_concentrations_used_input_file, signature))
+
+        return ready_plates
+
+    async def _worker(self, queue, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            plate_name, input_IPDA_file, DNA_concentrations_used_input_file, signature = await queue.get()
+            try:
+                plate_output_directory, missing_samples = await loop.run_in_executor(
+                    executor, _analyze_IPDA_plate_atomically, input_IPDA_file, DNA_concentrations_used_input_file,
+                    self.minimum_required_droplets, self.output_directory, self.output_format, self.cache,
+                    self.render_plots, self.stage_reports, self.concentration_store,
+                    self.results_store)
+            except Exception as error:
+                # a plate that failed is only tried again when one of its files changes
+                self._failed[plate_name] = signature
+                print(plate_name + ' failed: ' + type(error).__name__ + ': ' + str(error))
+            else:
+                self._processed[plate_name] = signature
+                self._failed.pop(plate_name, None)
+                print(plate_name + ' analyzed: ' + plate_output_directory)
+                if missing_samples:
+                    print(plate_name + ': no DNA concentrations for ' + ', '.join(missing_samples))
+            finally:
+                self._queued.discard(plate_name)
+                queue.task_done()
+
+    # the temporary folders of plates whose analysis was still running when the service crashed or was killed
+    # (and the old results of plates that were being replaced) are never renamed, so they are removed before the first look
+    def _remove_unfinished_plate_folders(self):
+        for pattern in ['.*.tmp', '.*.old']:
+            for unfinished_directory in glob.glob(os.path.join(self.output_directory, pattern)):
+                if os.path.isdir(unfinished_directory):
+                    shutil.rmtree(unfinished_directory, ignore_errors=True)
+
+    async def _run(self, watch):
+        self._remove_unfinished_plate_folders()
+        queue = asyncio.Queue()
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            workers = [asyncio.create_task(self._worker(queue, executor)) for _ in range(self.max_workers)]
+            try:
+                while True:
+                    for plate in self.ready_plates(wait_until_unchanged=watch):
+                        self._queued.add(plate[0])
+                        queue.put_nowait(plate)
+                    if not watch:
+                        await queue.join()
+                        return
+                    await asyncio.sleep(self.poll_interval)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+    # watches the input_directory until the service is stopped (e.g. with Ctrl+C)
+    def run(self):
+        asyncio.run(self._run(watch=True))
+
+    # analyzes all plates that are in the input_directory now and haven't been processed yet, then returns
+    def process_ready_plates(self):
+        asyncio.run(self._run(watch=False))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze IPDA plates as soon as they are exported into a folder.')
+    parser.add_argument('input_directory', help='folder the ddPCR .csv files and their DNA concentration .xlsx files are saved to')
+    parser.add_argument('--output-directory', default='output_files')
+    parser.add_argument('--minimum-required-droplets', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=2, help='number of plates analyzed at the same time')
+    parser.add_argument('--poll-interval', type=float, default=10, help='seconds between two looks at the input folder')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='xlsx')
+    parser.add_argument('--cache-directory', default=None, help='keep the parsed input files here to re-run faster')
+    parser.add_argument('--no-plots', action='store_true', help="don't draw the .png files")
+    parser.add_argument('--stage-reports', action='store_true', help='save the time and memory of each stage for every plate')
+    parser.add_argument('--concentration-store', default=None, help='SQLite file with the DNA concentrations of all samples')
+    parser.add_argument('--results-store', default=None, help='folder that collects the results of all plates')
+    parser.add_argument('--once', action='store_true', help='analyze the plates that are there now and stop')
+    arguments = parser.parse_args()
+
+    cache = None
+    if arguments.cache_directory is not None:
+        cache = IPDAInputCache(arguments.cache_directory)
+    concentration_store = None
+    if arguments.concentration_store is not None:
+        concentration_store = SampleConcentrationStore(arguments.concentration_store)
+    results_store = None
+    if arguments.results_store is not None:
+        results_store = IPDAResultsStore(arguments.results_store)
+
+    service = IPDAWatchService(arguments.input_directory, arguments.output_directory, arguments.minimum_required_droplets,
+                               arguments.workers, arguments.poll_interval, arguments.output_format, cache,
+                               not arguments.no_plots, arguments.stage_reports, concentration_store,
+                               results_store)
+    if arguments.once:
+        service.process_ready_plates()
+    else:
+        try:
+            service.run()
+        except KeyboardInterrupt:
+            pass